@@ -1,19 +1,40 @@
+import ast
+import base64
+import contextlib
+import hashlib
 import json
 import logging
 import os
 import re
 import shutil
 import shlex
+import socket
 import sys
+import threading
 import traceback
 import time
 
 import pdg
 from pdg.scheduler import PyScheduler, evaluateParamOr, convertEnvMapToUTF8
 from pdg.job.callbackserver import CallbackServerMixin
-from pdg.utils import TickTimer, expand_vars
+from pdg.utils import expand_vars
 from pdgjob import pdgcmd
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    import BaseHTTPServer as httpserver
+except ImportError:
+    import http.server as httpserver
+
 import af
 import afcommon
 import services.service
@@ -21,6 +42,589 @@ import services.service
 logging.basicConfig(level = logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Tokens replaced in work item commands.  The longest are tried first, and
+# anything around them is left alone, as in __PDG_ITEM_NAME___1.bgeo
+_PDG_TOKENS = ('__PDG_ITEM_NAME__', '__PDG_SHARED_TEMP__', '__PDG_TEMP__',
+    '__PDG_DIR__', '__PDG_SCRIPTDIR__', '__PDG_RESULT_SERVER__',
+    '__PDG_PYTHON__', '__PDG_HYTHON__')
+_PDG_TOKEN_RE = re.compile('|'.join(
+    re.escape(token) for token in sorted(_PDG_TOKENS, key=len, reverse=True)))
+
+# Lines of a work item log that are replayed for a work item re-attached
+# from an earlier session, whose job reported to that session's server.
+# Only the lines after the last start of the job count.
+_LOG_START_RE = re.compile(r'^PDG_START: ([^;]*);-1\s*$')
+_LOG_RESULT_RE = re.compile(r'^PDG_RESULT: ([^;]*);(-?\d+);(.*);([^;]*);(-?\d+)\s*$')
+_LOG_ATTR_RE = re.compile(r'^PDG_RESULT_ATTR: ([^;]*);([^;]*);(.*?)\s*$')
+
+# Files from $HOUDINI_USER_PREF_DIR/pdg/types needed by jobs on the farm
+_SUPPORT_FILES = ('pdgcmd.py',)
+
+# Longest a wait_ready_batch callback blocks, and how often it re-checks
+# readiness, which can also change through work items of other schedulers
+_READY_WAIT_MAX = 60.0
+_READY_RECHECK_INTERVAL = 0.2
+
+# PyScheduler is not told about parm changes, so the job template of a cook
+# is re-evaluated at most this often to pick up edits made during the cook
+_TEMPLATE_REFRESH_INTERVAL = 1.0
+
+
+class Histogram(object):
+    """
+    Counts observed durations, in seconds, in fixed buckets.
+    """
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for index, bound in enumerate(self.BOUNDS):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+            self.count += 1
+            self.total += value
+
+    def buckets(self):
+        """
+        Returns a list of (upper bound, count) pairs.
+        """
+        with self.lock:
+            return list(zip(self.BOUNDS, self.counts))
+
+
+class Metrics(object):
+    """
+    Counts events and times the stages of the scheduler.  Stage durations
+    can also be recorded as Chrome trace events.
+    """
+    MAX_TRACE_EVENTS = 1000000
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.events = None
+        self.lock = threading.Lock()
+
+    def histogram(self, stage):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            return histogram
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, start_time, end_time):
+        self.histogram(stage).observe(end_time - start_time)
+        events = self.events
+        if events is not None and len(events) < self.MAX_TRACE_EVENTS:
+            events.append({
+                'name' : stage,
+                'ph' : 'X',
+                'ts' : int(start_time * 1e6),
+                'dur' : int((end_time - start_time) * 1e6),
+                'pid' : os.getpid(),
+                'tid' : threading.current_thread().ident,
+            })
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, start_time, time.time())
+
+    def startTrace(self):
+        self.events = []
+
+    def dumpTrace(self, path):
+        """
+        Writes the trace events recorded since startTrace to path, in the
+        Chrome trace format, and stops recording.
+        """
+        events, self.events = self.events, None
+        if events is None:
+            return
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, trace_file)
+
+    def render(self, gauges=()):
+        """
+        Returns the metrics in the Prometheus text format.  gauges holds
+        extra (name, labels, value) samples.
+        """
+        with self.lock:
+            stages = sorted(self.stages.items())
+            counters = sorted(self.counters.items())
+
+        lines = ['# TYPE afanasy_stage_seconds histogram']
+        for stage, histogram in stages:
+            cumulative = 0
+            for bound, count in histogram.buckets():
+                cumulative += count
+                lines.append('afanasy_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    stage, '+Inf' if bound == float('inf') else bound, cumulative))
+            lines.append('afanasy_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram.total))
+            lines.append('afanasy_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram.count))
+        for name, value in counters:
+            lines.append('# TYPE afanasy_{}_total counter'.format(name))
+            lines.append('afanasy_{}_total {}'.format(name, value))
+        for name, labels, value in gauges:
+            label_text = ','.join('{}="{}"'.format(key, labels[key]) for key in sorted(labels))
+            lines.append('afanasy_{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(httpserver.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render_fn().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+    """
+    Serves render_fn() as text at /metrics, for Prometheus to scrape.
+    """
+    daemon_threads = True
+
+    def __init__(self, render_fn, port=0):
+        httpserver.HTTPServer.__init__(self, ('', port), _MetricsHandler)
+        self.render_fn = render_fn
+        self.port = self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class UsageStats(object):
+    """
+    Aggregates the resource usage jobs report as job_* attributes, per TOP
+    node.
+    """
+    ATTRIBUTES = ('job_walltime', 'job_usertime', 'job_systime', 'job_maxrss',
+                  'job_readbytes', 'job_writebytes')
+
+    def __init__(self):
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def observe(self, node_name, attr_name, value):
+        with self.lock:
+            metrics = self.nodes.setdefault(node_name, {})
+            count, total, peak = metrics.get(attr_name, (0, 0.0, 0.0))
+            metrics[attr_name] = (count + 1, total + value, max(peak, value))
+
+    def summary(self):
+        """
+        Returns {node name : {attribute : {'count', 'avg', 'max'}}}.
+        """
+        with self.lock:
+            return dict(
+                (node_name, dict(
+                    (attr_name, {'count' : count, 'avg' : total / count, 'max' : peak})
+                    for attr_name, (count, total, peak) in metrics.items()))
+                for node_name, metrics in self.nodes.items())
+
+
+class AdaptiveTickTimer(threading.Thread):
+    """
+    Calls tick_fn until cancelled.  While tick_fn returns True the interval
+    stays at min_interval, otherwise it doubles up to max_interval.  wake()
+    runs the next tick right away and resets the interval.
+    """
+    def __init__(self, tick_fn, min_interval, max_interval):
+        threading.Thread.__init__(self, name='afanasy-tick')
+        self.daemon = True
+        self.tick_fn = tick_fn
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        self.event = threading.Event()
+        self.cancelled = False
+
+    def run(self):
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            if self.cancelled:
+                return
+            if self.tick_fn():
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+
+    def wake(self):
+        self.interval = self.min_interval
+        self.event.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.event.set()
+
+
+class JobRecord(object):
+    """
+    The work item cooked by one task of an Afanasy job.
+    """
+    __slots__ = ('jid', 'task', 'item_name', 'node_name', 'state', 'submit_time', 'last_seen')
+
+    def __init__(self, jid, task, item_name, node_name, submit_time):
+        self.jid = jid
+        self.task = task
+        self.item_name = item_name
+        self.node_name = node_name
+        self.state = 'RDY'
+        self.submit_time = submit_time
+        self.last_seen = submit_time
+
+
+class JobRegistry(object):
+    """
+    Tracks the work items of the jobs in flight, indexed by job id, work
+    item name, state and node.  Work items only move forward from RDY to
+    RUN to one of the final states DON, ERR or CNC, so every transition is
+    reported once no matter whether polling or the job itself noticed it
+    first.  Records of finished work items are dropped; only their names
+    are kept until the next cook.  A job may report its work items before
+    it is added, so those early transitions are applied when it is.
+    """
+    RANKS = {'RDY' : 0, 'RUN' : 1, 'DON' : 2, 'ERR' : 2, 'CNC' : 2}
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.items = {}
+        self.states = {}
+        self.nodes = {}
+        self.progress = {}
+        self.finished = set()
+        self.started = set()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, jid, item_names, node_name):
+        """
+        Starts tracking a job with one task per name in item_names.  Returns
+        the names that are tracked, with None for the work items the job
+        already reported finished.
+        """
+        now = time.time()
+        with self.lock:
+            records = []
+            for task, item_name in enumerate(item_names):
+                record = JobRecord(jid, task, item_name, node_name, now)
+                records.append(record if self._track(record) else None)
+            if any(records):
+                self.jobs[jid] = records
+            return [record.item_name if record else None for record in records]
+
+    def attach(self, jid, task, task_count, item_name, node_name):
+        """
+        Starts tracking a single task of a job that was submitted by an
+        earlier session.
+        """
+        with self.lock:
+            record = JobRecord(jid, task, item_name, node_name, time.time())
+            if self._track(record):
+                self.jobs.setdefault(jid, [None] * task_count)[task] = record
+
+    def _track(self, record):
+        """
+        Indexes record, in the state its job reported before it was added.
+        Returns False if the job already reported it finished.
+        """
+        # a rescheduled work item replaces its previous job
+        previous = self.items.get(record.item_name)
+        if previous is not None:
+            self.states[previous.state].discard(previous)
+            self._remove(previous)
+            self.finished.discard(record.item_name)
+        elif record.item_name in self.finished:
+            # reschedule() clears the name before the job is sent
+            self.started.discard(record.item_name)
+            return False
+        if record.item_name in self.started:
+            self.started.discard(record.item_name)
+            record.state = 'RUN'
+
+        self.items[record.item_name] = record
+        self.nodes.setdefault(record.node_name, set()).add(record)
+        self.states.setdefault(record.state, set()).add(record)
+        return True
+
+    def jids(self):
+        with self.lock:
+            return list(self.jobs.keys())
+
+    def job(self, jid):
+        """
+        Returns the records of the tasks of a job, in task order, with None
+        for finished tasks.  Returns None for jobs that are not tracked.
+        """
+        return self.jobs.get(jid)
+
+    def record(self, item_name):
+        return self.items.get(item_name)
+
+    def records(self, state=None, node_name=None):
+        """
+        Returns the records in the given state and/or of the given node.
+        """
+        with self.lock:
+            if state is not None:
+                records = self.states.get(state, set())
+                if node_name is not None:
+                    records = records & self.nodes.get(node_name, set())
+            elif node_name is not None:
+                records = self.nodes.get(node_name, set())
+            else:
+                records = self.items.values()
+            return list(records)
+
+    def stateCounts(self):
+        with self.lock:
+            return dict((state, len(records)) for state, records in self.states.items())
+
+    def transition(self, item_name, state):
+        """
+        Moves a work item to state.  Returns True if PDG should be told,
+        that is the first time a work item reaches a later state, whether
+        it is tracked yet or not.
+        """
+        rank = self.RANKS[state]
+        with self.lock:
+            record = self.items.get(item_name)
+            if record is None:
+                if item_name in self.finished:
+                    return False
+                if rank == 2:
+                    self.started.discard(item_name)
+                    self.finished.add(item_name)
+                elif rank == 1:
+                    if item_name in self.started:
+                        return False
+                    self.started.add(item_name)
+                return True
+            if rank <= self.RANKS[record.state]:
+                return False
+
+            self.states[record.state].discard(record)
+            record.state = state
+            record.last_seen = time.time()
+            if rank < 2:
+                self.states.setdefault(state, set()).add(record)
+            else:
+                self._remove(record)
+            return True
+
+    def _remove(self, record):
+        self.finished.add(record.item_name)
+        del self.items[record.item_name]
+        self.nodes[record.node_name].discard(record)
+
+        # stop tracking the job once all of its tasks are finished
+        records = self.jobs[record.jid]
+        records[record.task] = None
+        if not any(records):
+            del self.jobs[record.jid]
+            self.progress.pop(record.jid, None)
+
+    def reschedule(self, item_name):
+        """
+        Allows a finished work item to be reported again, e.g. when it is
+        retried.
+        """
+        with self.lock:
+            self.finished.discard(item_name)
+            self.started.discard(item_name)
+
+    def clearFinished(self):
+        with self.lock:
+            self.finished.clear()
+            self.started.clear()
+
+
+class JobJournal(object):
+    """
+    Append-only log of the jobs submitted by the scheduler and the state
+    changes of their work items, one JSON object per line.  It lets a new
+    Houdini session find the jobs that are still running on the farm after
+    the previous one went away.  The journal is compacted down to the work
+    items in flight once it grows too long.  The scheduler holds lock around
+    a registry change and its journal line, so that a compaction never reads
+    the registry between the two.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lines = 0
+        self.lock = threading.RLock()
+
+    def load(self):
+        """
+        Reads the journal.  Returns a dict of the unfinished work items, as
+        item name -> (jid, task, task count, node name).
+        """
+        jobs = {}
+        items = {}
+        if not os.path.exists(self.path):
+            return items
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be torn by a crash
+                    continue
+                if entry['op'] == 'submit':
+                    jobs[entry['jid']] = entry
+                    item_names = entry['items']
+                    for task, item_name in enumerate(item_names):
+                        if item_name is not None:
+                            items[item_name] = (entry['jid'], task,
+                                len(item_names), entry['node'])
+                elif entry['op'] == 'state':
+                    if JobRegistry.RANKS[entry['state']] == 2:
+                        items.pop(entry['item'], None)
+        return items
+
+    def open(self):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def submit(self, jid, node_name, item_names):
+        self._write({'op' : 'submit', 'jid' : jid, 'node' : node_name,
+            'items' : list(item_names)})
+
+    def state(self, item_name, state):
+        self._write({'op' : 'state', 'item' : item_name, 'state' : state})
+
+    def _write(self, entry):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.lines += 1
+
+    def compact(self, jobs):
+        """
+        Rewrites the journal with only the given jobs, a list of
+        (jid, node name, item names) with None for finished tasks.
+        """
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for jid, node_name, item_names in jobs:
+                    f.write(json.dumps({'op' : 'submit', 'jid' : jid,
+                        'node' : node_name, 'items' : item_names}) + '\n')
+            reopen = self.file is not None
+            if reopen:
+                self.file.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+            self.lines = len(jobs)
+            self.file = open(self.path, 'a') if reopen else None
+
+
+class JsonLinesReceiver(threading.Thread):
+    """
+    Receives the callbacks pdgcmd sends as newline-delimited JSON over
+    persistent connections.  Each line is a [method, args...] list with the
+    arguments of the XML-RPC callback of the same name, and is passed on to
+    handle_fn(method, args).
+    """
+    def __init__(self, handle_fn, host=''):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.handle_fn = handle_fn
+        self.messages = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.closed = False
+
+    def run(self):
+        while not self.closed:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                break
+            reader = threading.Thread(target=self._serve, args=(conn,))
+            reader.daemon = True
+            reader.start()
+
+    def _serve(self, conn):
+        stream = conn.makefile('rb')
+        try:
+            for line in stream:
+                try:
+                    message = json.loads(line.decode('utf-8'))
+                    self.messages += 1
+                    self.handle_fn(message[0], [self._decode(arg) for arg in message[1:]])
+                except Exception:
+                    logger.error('Bad callback {!r}: {}'.format(line[:200], traceback.format_exc()))
+        except socket.error:
+            pass
+        finally:
+            stream.close()
+            conn.close()
+
+    @staticmethod
+    def _decode(arg):
+        # result data is bytes, sent as {"text": ...} if it is utf-8 and
+        # as {"b64": ...} otherwise
+        if isinstance(arg, dict):
+            if 'text' in arg:
+                return arg['text'].encode('utf-8')
+            if 'b64' in arg:
+                return base64.b64decode(arg['b64'])
+        return arg
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
 
 class AfanasyScheduler(CallbackServerMixin, PyScheduler):
     """
@@ -29,10 +633,33 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
     def __init__(self, scheduler, name):
         PyScheduler.__init__(self, scheduler, name)
         CallbackServerMixin.__init__(self, False)
-        self.active_jobs = {}
+        self.registry = JobRegistry()
+        self.journal = None
+        self.recovered = {}
+        self.reattached = set()
+        self.next_sweep = 0.0
+        self.sweep_jids = []
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.tick_durations = self.metrics.histogram('tick')
+        self.usage_stats = UsageStats()
+        self.pack_queue = {}
+        self.pack_lock = threading.Lock()
+        self.submit_queue = None
+        self.submit_workers = []
+        self.submit_lock = threading.Lock()
+        self.submit_count = 0
+        self.submit_failures = 0
+        self.submit_latency_total = 0.0
+        self.submit_latency_max = 0.0
+        self.stage_stats = None
+        self.job_template = None
+        self.job_template_time = 0.0
         self.tick_timer = None
         self.custom_port_range = None
         self.cook_id = '0'
+        self.ready_cond = threading.Condition()
+        self.stream_receiver = None
 
     @classmethod
     def templateName(cls):
@@ -108,6 +735,102 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
                     "label" : "Use Universal HFS",
                     "type" : "Integer",
                     "size" : 1,
+                },
+                {
+                    "name" : "packitems",
+                    "label" : "Pack Work Items Into Jobs",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "packsize",
+                    "label" : "Work Items Per Job",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "packinterval",
+                    "label" : "Pack Interval",
+                    "type" : "Float",
+                    "size" : 1,
+                },
+                {
+                    "name" : "submitthreads",
+                    "label" : "Submission Threads",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "submitqueuesize",
+                    "label" : "Submission Queue Size",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "submitretries",
+                    "label" : "Submission Retries",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "jobcallbacks",
+                    "label" : "Report Status From Jobs",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "reconcileinterval",
+                    "label" : "Reconcile Interval",
+                    "type" : "Float",
+                    "size" : 1,
+                },
+                {
+                    "name" : "tickmin",
+                    "label" : "Minimum Tick Interval",
+                    "type" : "Float",
+                    "size" : 1,
+                },
+                {
+                    "name" : "tickmax",
+                    "label" : "Maximum Tick Interval",
+                    "type" : "Float",
+                    "size" : 1,
+                },
+                {
+                    "name" : "tickbudget",
+                    "label" : "Tick Time Budget",
+                    "type" : "Float",
+                    "size" : 1,
+                },
+                {
+                    "name" : "tickchunk",
+                    "label" : "Jobs Per Query",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "journal",
+                    "label" : "Journal Jobs For Recovery",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "streamcallbacks",
+                    "label" : "Stream Callbacks As JSON Lines",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "metricsport",
+                    "label" : "Metrics Port",
+                    "type" : "Integer",
+                    "size" : 1,
+                },
+                {
+                    "name" : "tracecooks",
+                    "label" : "Write Cook Traces",
+                    "type" : "Integer",
+                    "size" : 1,
                 }
             ]
         })
@@ -194,7 +917,10 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
 
 
     def workItemResultServerAddr(self):
-        return self['address'].evaluateString()  
+        """
+        Returns the address of the callback server jobs report back to.
+        """
+        return CallbackServerMixin.workItemResultServerAddr(self)
 
     def onSchedule(self, work_item):
         """
@@ -208,6 +934,7 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
         """
         if len(work_item.command) == 0:
             return pdg.scheduleResult.CookSucceeded
+        start_time = time.time()
         try:
             item_name = work_item.name
             item_id = work_item.id
@@ -217,21 +944,9 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
 
             logger.debug('onSchedule input: {} {} {}'.format(node_name, item_name, item_command))
 
-            job_name = 'workitem_{}'.format(node_name)
-            task_name = item_name
-
-            temp_dir = self.tempDir(False)
-            work_dir = self.workingDir(False)
-            script_dir = self.scriptDir(False)
-
-            item_command = item_command.replace("__PDG_ITEM_NAME__", item_name)
-            item_command = item_command.replace("__PDG_SHARED_TEMP__", temp_dir)
-            item_command = item_command.replace("__PDG_TEMP__", temp_dir)
-            item_command = item_command.replace("__PDG_DIR__", work_dir)
-            item_command = item_command.replace("__PDG_SCRIPTDIR__", script_dir)
-            item_command = item_command.replace("__PDG_RESULT_SERVER__", self.workItemResultServerAddr())
-            item_command = item_command.replace("__PDG_PYTHON__", self.pythonBin(sys.platform))
-            item_command = item_command.replace("__PDG_HYTHON__", self.hythonBin(sys.platform))
+            with self.metrics.stage('substitute'):
+                template = self._jobTemplate()
+                item_command = self._substituteTokens(item_command, template['tokens'], item_name)
 
             cmd_argv = ' '.join(shlex.split(item_command))
 
@@ -239,87 +954,461 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
                 logger.error('Could not shelx command: ' + item_command)
                 return pdg.scheduleResult.Succeeded
 
-            # Ensure directories exist and serialize the work item
-            self.createJobDirsAndSerializeWorkItems(work_item)
+            # a work item may be scheduled again, e.g. when it is retried
+            self.registry.reschedule(item_name)
+            self.reattached.discard(item_name)
 
-            # Path PDGcmd file
-            src_file = os.environ.get('HOUDINI_USER_PREF_DIR') + '/pdg/types/pdgcmd.py'
-            dest_file = script_dir + '/' + 'pdgcmd.py'
-            shutil.copy(src_file, dest_file)
+            # pick up the job of a previous session if it is still around
+            if self._reattachWorkItem(work_item):
+                return pdg.scheduleResult.Succeeded
 
-            # Create Job
-            job = af.Job(job_name)
-
-            # Job Parameters
-            job.setBranch(self['job_branch'].evaluateString())
-            job.setDependMask(self['depend_mask'].evaluateString())
-            job.setDependMaskGlobal(self['depend_mask_global'].evaluateString())
-            job.setPriority(self['priority'].evaluateInt())
-            job.setMaxRunningTasks(self['max_runtasks'].evaluateInt())
-            job.setMaxRunTasksPerHost(self['maxperhost'].evaluateInt())
-            job.setHostsMask(self['hosts_mask'].evaluateString())
-            job.setHostsMaskExclude(self['hosts_mask_exclude'].evaluateString())
-
-            service = 'generic'
-            parser = 'generic'
-
-            # Create a block with provided name and service type
-            block = af.Block(job_name, service)
-            block.setService(service)
-            block.setParser(parser)
-            block.setCapacity(self['capacity'].evaluateInt())
-            #block.setVariableCapacity(self['capacity_coefficient1'].evaluateInt(), self['capacity_coefficient2'].evaluateInt())
-            block.setTaskMinRunTime(self['minruntime'].evaluateInt())
-            block.setTaskMaxRunTime(self['maxruntime'].evaluateInt() * 3600)
+            # Queue the item up to be sent together with its siblings, or
+            # hand it over to the submission workers
+            pack = [(work_item, cmd_argv)]
+            if template['packitems'] > 0:
+                self._packWorkItem(work_item, cmd_argv)
+            elif self.submit_workers:
+                self._queueSubmission(node_name, pack)
+            else:
+                self._submit(node_name, pack, time.time())
 
-            # Set Enviroment Task Variables
-            block.setEnv('PDG_RESULT_SERVER', str(self.workItemResultServerAddr()))
-            block.setEnv('PDG_ITEM_NAME', str('workitem_{}'.format(item_name)))
-            block.setEnv('PDG_DIR', str(work_dir))
-            block.setEnv('PDG_TEMP', str(temp_dir))
-            block.setEnv('PDG_SHARED_TEMP', str(temp_dir))
-            block.setEnv('PDG_INDEX', str(work_item.index))
-            block.setEnv('PDG_INDEX4', "{:04d}".format(work_item.index))
-            block.setEnv('PDG_SCRIPTDIR', str(script_dir))
-            block.setEnv('PDG_JOBID', self.cook_id)
-            block.setEnv('PDG_JOBID_VAR', 'PDG_JOBID')
-
-            task = af.Task(task_name)
-            task.setCommand(cmd_argv)
-            block.tasks.append(task)
+            return pdg.scheduleResult.Succeeded
 
-            job.blocks.append(block)
+        except:
+            import traceback
+            traceback.print_exc()
+            sys.stderr.flush()
+            return pdg.scheduleResult.Failed
 
-            newjid = 0
-            logger.debug('onScheduler new job [jid=%d]:' % newjid)
+        finally:
+            self.metrics.observe('schedule', start_time, time.time())
 
+    def _evaluateParm(self, name, default):
+        """
+        Evaluates an optional scheduler parm.  Returns default if the parm
+        does not exist on the scheduler node, e.g. with an older HDA.
+        """
+        try:
+            parm = self[name]
+        except Exception:
+            parm = None
+        if parm is None:
+            return default
+        if isinstance(default, int):
+            return parm.evaluateInt()
+        if isinstance(default, float):
+            return parm.evaluateFloat()
+        return parm.evaluateString()
+
+    def _jobTemplate(self):
+        """
+        Returns the job template of the current cook, evaluating the
+        scheduler parms if there is none yet or if the template is older
+        than _TEMPLATE_REFRESH_INTERVAL, so that parms edited during the cook
+        apply to the jobs scheduled after the edit.
+        """
+        template = self.job_template
+        now = time.time()
+        if template is None or now - self.job_template_time >= _TEMPLATE_REFRESH_INTERVAL:
+            template = self._evaluateJobTemplate()
+            self.job_template = template
+            self.job_template_time = now
+        return template
+
+    def _evaluateJobTemplate(self):
+        """
+        Evaluates the scheduler parms and command token values used by every
+        job of a cook.  Called in onStartCook and then at most once per
+        _TEMPLATE_REFRESH_INTERVAL, so that onSchedule only has to build the
+        task itself.
+        """
+        temp_dir = self.tempDir(False)
+        work_dir = self.workingDir(False)
+        script_dir = self.scriptDir(False)
+        result_server = str(self.workItemResultServerAddr())
+
+        env = [
+            ('PDG_RESULT_SERVER', result_server),
+            ('PDG_DIR', str(work_dir)),
+            ('PDG_TEMP', str(temp_dir)),
+            ('PDG_SHARED_TEMP', str(temp_dir)),
+            ('PDG_SCRIPTDIR', str(script_dir)),
+            ('PDG_JOBID', self.cook_id),
+            ('PDG_JOBID_VAR', 'PDG_JOBID'),
+        ]
+        if self.stream_receiver:
+            env.append(('PDG_STREAM_SERVER', '{}:{}'.format(
+                result_server.rsplit(':', 1)[0], self.stream_receiver.port)))
+
+        return {
+            'job_branch' : self['job_branch'].evaluateString(),
+            'depend_mask' : self['depend_mask'].evaluateString(),
+            'depend_mask_global' : self['depend_mask_global'].evaluateString(),
+            'priority' : self['priority'].evaluateInt(),
+            'max_runtasks' : self['max_runtasks'].evaluateInt(),
+            'maxperhost' : self['maxperhost'].evaluateInt(),
+            'hosts_mask' : self['hosts_mask'].evaluateString(),
+            'hosts_mask_exclude' : self['hosts_mask_exclude'].evaluateString(),
+            'capacity' : self['capacity'].evaluateInt(),
+            'minruntime' : self['minruntime'].evaluateInt(),
+            'maxruntime' : self['maxruntime'].evaluateInt() * 3600,
+            'packitems' : self._evaluateParm('packitems', 0),
+            'packsize' : self._evaluateParm('packsize', 100),
+            'packinterval' : self._evaluateParm('packinterval', 1.0),
+            'submitretries' : self._evaluateParm('submitretries', 3),
+            'jobcallbacks' : self._evaluateParm('jobcallbacks', 1),
+            'reconcileinterval' : self._evaluateParm('reconcileinterval', 10.0),
+            'tickmin' : self._evaluateParm('tickmin', 0.05),
+            'tickmax' : self._evaluateParm('tickmax', 2.0),
+            'tickbudget' : self._evaluateParm('tickbudget', 0.1),
+            'tickchunk' : self._evaluateParm('tickchunk', 1000),
+            'journal' : self._evaluateParm('journal', 1),
+            'env' : env,
+            'tokens' : {
+                '__PDG_SHARED_TEMP__' : temp_dir,
+                '__PDG_TEMP__' : temp_dir,
+                '__PDG_DIR__' : work_dir,
+                '__PDG_SCRIPTDIR__' : script_dir,
+                '__PDG_RESULT_SERVER__' : result_server,
+                '__PDG_PYTHON__' : self.pythonBin(sys.platform),
+                '__PDG_HYTHON__' : self.hythonBin(sys.platform),
+            },
+        }
+
+    def _substituteTokens(self, command, tokens, item_name):
+        """
+        Replaces the known __PDG_*__ tokens in command in a single pass.
+        """
+        def replace(match):
+            token = match.group(0)
+            if token == '__PDG_ITEM_NAME__':
+                return item_name
+            return tokens.get(token, token)
+        return _PDG_TOKEN_RE.sub(replace, command)
+
+    def _wrapCommand(self, cmd_argv):
+        """
+        Wraps the command of a task with pdgcmd.py so the job reports its
+        start, success and failure straight to the callback server.
+        """
+        template = self._jobTemplate()
+        if not template['jobcallbacks']:
+            return cmd_argv
+        tokens = template['tokens']
+        return '"{}" "{}/pdgcmd.py" {}'.format(
+            tokens['__PDG_PYTHON__'], tokens['__PDG_SCRIPTDIR__'], cmd_argv)
+
+    def _createJob(self, job_name):
+        """
+        Creates an Afanasy job with a single block configured from the
+        job template.  Returns the job and the block to add tasks to.
+        """
+        template = self._jobTemplate()
+
+        # Create Job
+        job = af.Job(job_name)
+
+        # Job Parameters
+        job.setBranch(template['job_branch'])
+        job.setDependMask(template['depend_mask'])
+        job.setDependMaskGlobal(template['depend_mask_global'])
+        job.setPriority(template['priority'])
+        job.setMaxRunningTasks(template['max_runtasks'])
+        job.setMaxRunTasksPerHost(template['maxperhost'])
+        job.setHostsMask(template['hosts_mask'])
+        job.setHostsMaskExclude(template['hosts_mask_exclude'])
+
+        service = 'generic'
+        parser = 'generic'
+
+        # Create a block with provided name and service type
+        block = af.Block(job_name, service)
+        block.setService(service)
+        block.setParser(parser)
+        block.setCapacity(template['capacity'])
+        #block.setVariableCapacity(self['capacity_coefficient1'].evaluateInt(), self['capacity_coefficient2'].evaluateInt())
+        block.setTaskMinRunTime(template['minruntime'])
+        block.setTaskMaxRunTime(template['maxruntime'])
+
+        # Set Enviroment Variables shared by all tasks
+        for name, value in template['env']:
+            block.setEnv(name, value)
+
+        job.blocks.append(block)
+        return job, block
+
+    def _sendJob(self, job, item_names, node_name):
+        """
+        Submits the job and starts tracking it.  item_names holds the name
+        of the work item cooked by each task of the job, in task order.
+        Failed sends are retried submitretries times with an exponential
+        backoff.  Returns the new job id.
+        """
+        retries = self._jobTemplate()['submitretries']
+        attempt = 0
+        while True:
             try:
-                newjid = job.send()
+                with self.metrics.stage('send'):
+                    newjid = job.send()
                 newjid = newjid[1]['id']
-            except Exception,err:
-                import traceback
-                traceback.print_exc()
-                sys.stderr.flush()
-                raise RuntimeError('Error creating job for ' + item_name + ':\n' + str(err))
-            
-            # add to active jobs list
-            self.active_jobs[newjid] = item_name
-            work_item.data.setInt("afanasy_jobid", newjid, 0)
+                break
+            except Exception as err:
+                self.metrics.count('send_errors')
+                if attempt >= retries:
+                    raise RuntimeError('Error creating job for ' + ', '.join(item_names) + ':\n' + str(err))
+                delay = min(0.5 * 2 ** attempt, 30.0)
+                logger.debug('Error creating job for {}, retrying in {}s: {}'.format(
+                    ', '.join(item_names), delay, err))
+                time.sleep(delay)
+                attempt += 1
+
+        logger.debug('onScheduler new job [jid=%d]:' % newjid)
+
+        self.metrics.count('jobs_submitted')
+
+        # add to active jobs list
+        journal = self.journal
+        if journal is None:
+            self.registry.add(newjid, item_names, node_name)
+        else:
+            with journal.lock:
+                tracked = self.registry.add(newjid, item_names, node_name)
+                if any(tracked):
+                    journal.submit(newjid, node_name, tracked)
+        return newjid
 
-            return pdg.scheduleResult.Succeeded
+    def _packWorkItem(self, work_item, cmd_argv):
+        """
+        Queues a work item to be sent as one task of a job shared with the
+        other ready items of the same node.  The job is sent as soon as
+        packsize items are queued, or by tick() once the oldest queued item
+        has waited packinterval seconds.
+        """
+        node_name = work_item.node.name
+        with self.pack_lock:
+            if node_name not in self.pack_queue:
+                self.pack_queue[node_name] = (time.time(), [])
+                # make sure the tick timer is not backing off
+                if self.tick_timer:
+                    self.tick_timer.wake()
+            pack = self.pack_queue[node_name][1]
+            pack.append((work_item, cmd_argv))
+            if len(pack) < self._jobTemplate()['packsize']:
+                return
+            del self.pack_queue[node_name]
+        self._queueSubmission(node_name, pack)
+
+    def _flushPackedWorkItems(self, force=False):
+        """
+        Sends the queued work items of every node whose oldest item has
+        waited longer than packinterval, or of all nodes if force is True.
+        Returns the number of jobs sent.
+        """
+        if not self.pack_queue:
+            return 0
+        now = time.time()
+        interval = self._jobTemplate()['packinterval']
+        with self.pack_lock:
+            node_names = [node_name for node_name, (queued, pack)
+                in self.pack_queue.items() if force or now - queued >= interval]
+            packs = [(node_name, self.pack_queue.pop(node_name)[1])
+                for node_name in node_names]
+        for node_name, pack in packs:
+            self._queueSubmission(node_name, pack)
+        return len(packs)
+
+    def _queueSubmission(self, node_name, pack):
+        """
+        Hands the work items in pack over to the submission workers.  Blocks
+        while the submission queue is full.  Without workers the items are
+        submitted right away.
+        """
+        if self.submit_workers:
+            self.submit_queue.put((time.time(), node_name, pack))
+        else:
+            self._submitOrFail(time.time(), node_name, pack)
+
+    def _submitWorker(self):
+        """
+        Submission worker thread.  Submits queued work items until it picks
+        up None from the queue.
+        """
+        while True:
+            submission = self.submit_queue.get()
+            if submission is None:
+                return
+            self._submitOrFail(*submission)
 
+    def _submitOrFail(self, queued_time, node_name, pack):
+        """
+        Submits the work items in pack, and reports them as failed if that
+        is not possible since onSchedule has already returned for them.
+        """
+        try:
+            self._submit(node_name, pack, queued_time)
         except:
             import traceback
             traceback.print_exc()
             sys.stderr.flush()
-            return pdg.scheduleResult.Failed
+            with self.submit_lock:
+                self.submit_failures += 1
+            for work_item, cmd_argv in pack:
+                self.workItemFailed(work_item.name, -1)
+
+    def _submit(self, node_name, pack, queued_time):
+        """
+        Prepares the job directories of the work items in pack and sends
+        them as a single job with one task per work item.  queued_time is
+        the time the work items were scheduled at.  Returns the new job id.
+        """
+        with self.metrics.stage('serialize'):
+            for work_item, cmd_argv in pack:
+                # Ensure directories exist and serialize the work item
+                self.createJobDirsAndSerializeWorkItems(work_item)
+
+        job, block = self._createJob('workitem_{}'.format(node_name))
+        item_names = []
+        for work_item, cmd_argv in pack:
+            item_name = work_item.name
+            task = af.Task(item_name)
+            task.setCommand(self._wrapCommand(cmd_argv))
+            block.tasks.append(task)
+            item_names.append(item_name)
+
+            # Set Enviroment Task Variables
+            if len(pack) == 1:
+                env = block
+            else:
+                env = task
+            env.setEnv('PDG_ITEM_NAME', str(item_name))
+            env.setEnv('PDG_INDEX', str(work_item.index))
+            env.setEnv('PDG_INDEX4', "{:04d}".format(work_item.index))
+
+        newjid = self._sendJob(job, item_names, node_name)
+
+        for task_index, (work_item, cmd_argv) in enumerate(pack):
+            work_item.data.setInt("afanasy_jobid", newjid, 0)
+            if len(pack) > 1:
+                work_item.data.setInt("afanasy_task", task_index, 0)
+
+        latency = time.time() - queued_time
+        with self.submit_lock:
+            self.submit_count += 1
+            self.submit_latency_total += latency
+            self.submit_latency_max = max(self.submit_latency_max, latency)
+        return newjid
+
+    def _stageSupportFiles(self):
+        """
+        Copies the files needed by jobs on the farm into the script dir.
+        Called once per cook; files whose content did not change since the
+        last cook are not rewritten.
+        """
+        start_time = time.time()
+        src_dir = os.environ.get('HOUDINI_USER_PREF_DIR') + '/pdg/types'
+        script_dir = self.scriptDir(True)
+        if not os.path.exists(script_dir):
+            os.makedirs(script_dir)
+
+        total_bytes = 0
+        copied_bytes = 0
+        for file_name in _SUPPORT_FILES:
+            src_file = src_dir + '/' + file_name
+            dest_file = script_dir + '/' + file_name
+            with open(src_file, 'rb') as f:
+                data = f.read()
+            total_bytes += len(data)
+            if os.path.exists(dest_file):
+                with open(dest_file, 'rb') as f:
+                    if hashlib.md5(f.read()).digest() == hashlib.md5(data).digest():
+                        continue
+            shutil.copy(src_file, dest_file)
+            copied_bytes += len(data)
+
+        self.stage_stats = {
+            'time' : time.time() - start_time,
+            'total_bytes' : total_bytes,
+            'copied_bytes' : copied_bytes,
+            'submit_count' : self.submit_count,
+        }
+        logger.debug('Staged support files in {:.3f}s: {} of {} bytes copied'.format(
+            self.stage_stats['time'], copied_bytes, total_bytes))
+
+    def _logStagingSavings(self):
+        """
+        Logs how many copies of the support files staging saved this cook,
+        compared to copying them for every job.
+        """
+        stats = self.stage_stats
+        if not stats:
+            return
+        jobs = self.submit_count - stats['submit_count']
+        saved_bytes = jobs * stats['total_bytes'] - stats['copied_bytes']
+        saved_time = jobs * stats['time']
+        logger.debug('Staging support files saved {} copies, {} bytes and ~{:.3f}s'.format(
+            jobs, saved_bytes, saved_time))
+
+    def _startSubmitWorkers(self):
+        """
+        Starts submitthreads submission workers, stopping the running ones
+        first if their number changed.  With 0 threads work items are sent
+        synchronously from onSchedule.
+        """
+        count = self._evaluateParm('submitthreads', 4)
+        if count == len(self.submit_workers):
+            return
+        self._stopSubmitWorkers()
+
+        self.submit_queue = queue.Queue(self._evaluateParm('submitqueuesize', 1000))
+        for index in range(count):
+            worker = threading.Thread(target=self._submitWorker,
+                name='afanasy-submit-{}'.format(index))
+            worker.daemon = True
+            worker.start()
+            self.submit_workers.append(worker)
+
+    def _stopSubmitWorkers(self):
+        """
+        Stops the submission workers once they sent all queued work items.
+        """
+        for worker in self.submit_workers:
+            self.submit_queue.put(None)
+        for worker in self.submit_workers:
+            worker.join()
+        self.submit_workers = []
+
+    def _dropQueuedSubmissions(self):
+        """
+        Removes all work items that are still waiting to be submitted.
+        """
+        while self.submit_queue is not None:
+            try:
+                self.submit_queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def submissionStats(self):
+        """
+        Returns a dict with the current depth of the submission queue and
+        the number and latency of the submissions made so far.  Latency is
+        measured from onSchedule until the job is accepted by the server.
+        """
+        with self.submit_lock:
+            count = self.submit_count
+            return {
+                'queue_depth' : self.submit_queue.qsize() if self.submit_queue else 0,
+                'submitted' : count,
+                'failed' : self.submit_failures,
+                'latency_avg' : self.submit_latency_total / count if count else 0.0,
+                'latency_max' : self.submit_latency_max,
+            }
 
     def onScheduleStatic(self, dependencies, dependents, ready_items):
         return
 
     def onStart(self):
         logger.debug("onStart")
-        self.startCallbackServer()
+        self._startCallbackServer()
         """
         onStart(self) -> boolean
 
@@ -337,6 +1426,9 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
         communicating with Tractor.
         """
         self.stopCallbackServer()
+        self._stopStreamReceiver()
+        self._stopMetricsServer()
+        self._stopSubmitWorkers()
         self._stopSharedServers()
         return True
 
@@ -347,6 +1439,8 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
         [virtual] Cook start callback. Starts a root job for the cook session
         """
         self.cook_id = str(int(self.cook_id) + 1)
+        self.registry.clearFinished()
+        self.next_sweep = 0.0
 
         # sanity check the local shared root
         localsharedroot = self._localsharedroot()
@@ -367,12 +1461,39 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
             if callbackportrange != self.custom_port_range:
                 self.custom_port_range = callbackportrange
                 self.stopCallbackServer()
-                self.startCallbackServer()
+                self._startCallbackServer()
         
         if not self.isCallbackServerRunning():
-            self.startCallbackServer()
+            self._startCallbackServer()
         
-        self.tick_timer = TickTimer(0.25, self.tick)
+        if self._evaluateParm('streamcallbacks', 0):
+            self._startStreamReceiver()
+        else:
+            self._stopStreamReceiver()
+
+        metricsport = self._evaluateParm('metricsport', -1)
+        if metricsport >= 0:
+            self._startMetricsServer(metricsport)
+        else:
+            self._stopMetricsServer()
+        if self._evaluateParm('tracecooks', 0):
+            self.metrics.startTrace()
+
+        # evaluate the parms shared by all jobs of this cook
+        self.job_template = self._evaluateJobTemplate()
+        self.job_template_time = time.time()
+
+        # copy pdgcmd.py and friends to where the jobs can find them
+        self._stageSupportFiles()
+
+        # find the jobs of a previous session that are still on the farm
+        self._openJournal()
+
+        self._startSubmitWorkers()
+
+        self.sweep_jids = []
+        self.tick_timer = AdaptiveTickTimer(self.tick,
+            self.job_template['tickmin'], self.job_template['tickmax'])
         self.tick_timer.start()
 
         return True
@@ -380,71 +1501,475 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
     def tick(self):
         """
         Called during a cook. Checks on jobs in flight to see if
-        any have finished.
+        any have finished.  Returns True if there was any activity or a poll
+        left to finish, which keeps the tick timer at its shortest interval.
         """
+        start_time = time.time()
+        try:
+            changes = self._tick(start_time)
+        except:
+            import traceback
+            traceback.print_exc()
+            sys.stderr.flush()
+            changes = 0
+        self.metrics.observe('tick', start_time, time.time())
+
+        # keep the journal from growing without bounds
+        if self.journal and self.journal.lines > 1000 + 4 * len(self.registry.items):
+            self._compactJournal()
+
+        # a poll cut short by tickbudget resumes on the next tick
+        return changes > 0 or bool(self.pack_queue) or bool(self.sweep_jids)
+
+    def _tick(self, start_time):
+        """
+        Flushes packed work items and continues the current poll of the
+        jobs in flight for at most tickbudget seconds.  A poll that runs out
+        of time is resumed by the next tick, so that all jobs get their turn.
+        Returns the number of state changes found.
+        """
+        changes = self._flushPackedWorkItems()
+
+        if not self.sweep_jids:
+            if not len(self.registry):
+                return changes
+
+            # with job callbacks, polling only has to catch lost jobs
+            template = self._jobTemplate()
+            if template['jobcallbacks']:
+                if start_time < self.next_sweep:
+                    return changes
+                self.next_sweep = start_time + template['reconcileinterval']
+            self.sweep_jids = self.registry.jids()
+
+        template = self._jobTemplate()
+        budget = template['tickbudget']
+        chunk_size = max(template['tickchunk'], 1)
+
         # create job command
         cmd = af.Cmd()
-        try:
-            # check job/task statuses and remove them if finished
-            for id in self.active_jobs.keys():
-                # query job progress
-                if cmd.getJobProgress(id) is None:
-                	work_item_name = self.active_jobs[id]
-                	self.workItemFailed(work_item_name, -1)
-                	del self.active_jobs[id]
-                	continue
-
-                query = cmd.getJobProgress(id)['progress'][0]
-                job_info = cmd.getJobInfo(id)[0]
-                while query:
-                    if isinstance(query, dict):
-                        break
-                    query = query[0]
-
-                # task state 
-                task = query['state']
-
-                logger.debug('task_state for {} = {}'.format(id, task))
-                if len(task) < 1:
-                    # this is a ghost-job - consider it failed
-                    work_item_name = self.active_jobs[id]
+        while self.sweep_jids:
+            jids = self.sweep_jids[:chunk_size]
+            del self.sweep_jids[:chunk_size]
+            changes += self._updateJobs(cmd, jids)
+            if budget > 0 and time.time() - start_time >= budget:
+                break
+        return changes
+
+    def _updateJobs(self, cmd, jids):
+        """
+        Queries the given jobs with a single request and reports the tasks
+        whose state changed to PDG.  Returns the number of state changes.
+        """
+        with self.metrics.stage('query'):
+            job_list = cmd.getJobList(ids=jids)
+        self.metrics.count('jobs_polled', len(jids))
+        if job_list is None:
+            logger.debug('tick: could not query {} jobs'.format(len(jids)))
+            return 0
+
+        changes = 0
+        job_infos = {}
+        for job_info in job_list:
+            job_infos[job_info['id']] = job_info
+
+        # jobs the server no longer knows about are considered failed
+        if len(job_infos) != len(jids):
+            for id in jids:
+                if id not in job_infos and self.registry.job(id) is not None:
+                    self._onJobRemoved(id)
+                    changes += 1
+
+        # check job statuses and only look at the ones that changed
+        for id, job_info in job_infos.items():
+            records = self.registry.job(id)
+            if records is None:
+                continue
+
+            job_progress = self._jobProgress(job_info)
+            if job_progress == self.registry.progress.get(id):
+                continue
+            self.registry.progress[id] = job_progress
+            changes += 1
+
+            if len(records) == 1:
+                self._onTaskState(records[0], self._taskState(job_info),
+                    job_info.get('time_started'), job_info.get('time_done'))
+                continue
+
+            # packed job - fetch the state of the individual tasks
+            with self.metrics.stage('query_tasks'):
+                query = cmd.getJobProgress(id)
+            if query is None:
+                self._onJobRemoved(id)
+                continue
+            for record, task_info in zip(records, query['progress'][0]):
+                if record is not None:
+                    self._onTaskState(record, self._taskState(task_info),
+                        task_info.get('tst'), task_info.get('tdn'))
+        return changes
+
+    def tickStats(self):
+        """
+        Returns the current tick interval and a histogram of tick durations
+        in seconds, as a list of (upper bound, count) pairs.
+        """
+        return {
+            'interval' : self.tick_timer.interval if self.tick_timer else 0.0,
+            'durations' : self.tick_durations.buckets(),
+        }
+
+    def _jobProgress(self, job_info):
+        """
+        Returns a value that changes whenever the state of the job or the
+        progress of any of its tasks changes.
+        """
+        return (job_info.get('state'), tuple(
+            (block.get('p_tasks_done'), block.get('p_tasks_error'),
+             block.get('running_tasks_counter'), block.get('p_percentage'))
+            for block in job_info.get('blocks', ())))
+
+    def _taskState(self, info):
+        """
+        Reduces the state string of an Afanasy job or task to one of 'RUN',
+        'DON', 'ERR' or 'RDY'.  Returns None for a ghost job without any
+        state.
+        """
+        states = info.get('state', '').split()
+        if not states:
+            return None
+        if 'ERR' in states or 'RER' in states:
+            return 'ERR'
+        if 'DON' in states or 'SKP' in states:
+            return 'DON'
+        if 'RUN' in states:
+            return 'RUN'
+        return 'RDY'
+
+    def _onTaskState(self, record, task_state, time_started, time_done):
+        """
+        Reports the state of a task to PDG if it changed since it was last
+        seen.
+        """
+        if task_state == record.state:
+            return
+        work_item_name = record.item_name
+
+        logger.debug('task_state for {}.{} = {}'.format(record.jid, record.task, task_state))
+        if task_state is None or task_state == 'ERR':
+            self.workItemFailed(work_item_name, -1)
+        elif task_state == 'DON':
+            if work_item_name in self.reattached:
+                self.reattached.discard(work_item_name)
+                if not self._replayLog(work_item_name):
                     self.workItemFailed(work_item_name, -1)
-                    del self.active_jobs[id]
-                    continue
+                    return
+            cook_timedelta = float((time_done or 0) - (time_started or 0))
+            self.workItemSucceeded(work_item_name, -1, cook_timedelta)
+        elif task_state == 'RUN':
+            self.workItemStartCook(work_item_name, -1)
 
-                task_state = task.strip()
+    def _transition(self, name, state):
+        """
+        Moves a work item to state in the registry, and records the change
+        in the journal.  Returns True if PDG should be told.
+        """
+        journal = self.journal
+        if journal is None:
+            return self.registry.transition(name, state)
+        with journal.lock:
+            if not self.registry.transition(name, state):
+                return False
+            journal.state(name, state)
+        return True
 
-                if task_state == 'RUN':
-                	work_item_name = self.active_jobs[id]
-                	self.workItemStartCook(work_item_name, -1)
+    def _startCallbackServer(self):
+        """
+        Starts the callback server, and adds the wait_ready_batch callback
+        if it serves each request in its own thread, so that blocking
+        waits cannot hold up the other callbacks.
+        """
+        self.startCallbackServer()
+        server = getattr(self, 'server', None)
+        if isinstance(server, socketserver.ThreadingMixIn):
+            server.register_function(self.waitReadyBatch, 'wait_ready_batch')
+        if hasattr(server, 'register_function'):
+            server.register_function(self.metricsText, 'metrics')
 
-                if task_state == 'RDY RER':
-                    work_item_name = self.active_jobs[id]
-                    self.workItemFailed(work_item_name, -1)
-                    del self.active_jobs[id]
-                    continue
+    def metricsText(self):
+        """
+        Returns the stage timings, counters and work item counts in the
+        Prometheus text format.
+        """
+        gauges = [('work_items', {'state' : state}, count)
+                  for state, count in sorted(self.registry.stateCounts().items())]
+        gauges.append(('submit_queue_depth', {},
+                       self.submit_queue.qsize() if self.submit_queue else 0))
+        gauges.append(('tick_interval_seconds', {},
+                       self.tick_timer.interval if self.tick_timer else 0.0))
+        return self.metrics.render(gauges)
+
+    def _startMetricsServer(self, port):
+        """
+        Serves metricsText at http://<host>:<port>/metrics, on any free port
+        if port is 0.
+        """
+        if self.metrics_server and port in (0, self.metrics_server.port):
+            return
+        self._stopMetricsServer()
+        try:
+            self.metrics_server = MetricsServer(self.metricsText, port)
+        except socket.error as err:
+            logger.error('Could not serve metrics on port {}: {}'.format(port, err))
+            return
+        logger.debug('Serving metrics at http://{}:{}/metrics'.format(
+            socket.gethostname(), self.metrics_server.port))
+
+    def _stopMetricsServer(self):
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+    def _startStreamReceiver(self):
+        """
+        Starts listening for callbacks streamed as JSON lines.  Jobs find
+        the receiver through $PDG_STREAM_SERVER.
+        """
+        if self.stream_receiver is None:
+            self.stream_receiver = JsonLinesReceiver(self._onStreamedCallback)
+            self.stream_receiver.start()
 
-                elif task_state == 'DON' or task_state == 'SKP':
-                    statetime = job_info.get('time_started')
-                    activetime = job_info.get('time_done')
-                    cook_timedelta = float(activetime - statetime)
-                    work_item_name = self.active_jobs[id]
-                    self.workItemSucceeded(work_item_name, -1, cook_timedelta)
-                    del self.active_jobs[id]
-                    continue
+    def _stopStreamReceiver(self):
+        if self.stream_receiver:
+            logger.debug('Streamed callbacks: {}'.format(self.stream_receiver.messages))
+            self.stream_receiver.close()
+            self.stream_receiver = None
+
+    def _onStreamedCallback(self, method, args):
+        """
+        Handles a callback received by the JSON lines receiver, taking the
+        same arguments as the XML-RPC callback of the same name.
+        """
+        if method == 'start_cook':
+            name, jobid = args
+            self.workItemStartCook(name, -1, jobid)
+        elif method == 'start_cook_batch':
+            name, subindex, jobid = args
+            self.workItemStartCook(name, subindex, jobid)
+        elif method == 'success':
+            name, duration, jobid = args
+            self.workItemSucceeded(name, -1, duration, jobid)
+        elif method == 'failed':
+            name, jobid = args
+            self.workItemFailed(name, -1, jobid)
+        elif method == 'result':
+            name, result, tag, checksum, jobid = args
+            self.workItemFileResult(name, -1, result, tag, checksum, jobid)
+        elif method == 'result_batch':
+            name, result, tag, subindex, checksum, jobid = args
+            self.workItemFileResult(name, subindex, result, tag, checksum, jobid)
+        elif method == 'success_and_result':
+            name, result, tag, checksum, duration, jobid = args
+            self.workItemFileResult(name, -1, result, tag, checksum, jobid)
+            self.workItemSucceeded(name, -1, duration, jobid)
+        elif method == 'success_and_result_batch':
+            name, result, tag, subindex, checksum, duration, jobid = args
+            self.workItemFileResult(name, subindex, result, tag, checksum, jobid)
+            self.workItemSucceeded(name, subindex, duration, jobid)
+        elif method == 'write_attr':
+            name, attr_name, data, jobid = args
+            self.workItemSetAttribute(name, -1, attr_name, data, jobid)
+        else:
+            logger.error('Unknown streamed callback: {}'.format(method))
+
+    def waitReadyBatch(self, item_name, subindex, timeout):
+        """
+        Blocks until the batch sub item can begin cooking or timeout seconds
+        have passed, and returns 1 if it can.  A waiting sub item costs one
+        request per timeout instead of one per poll interval.
+        """
+        deadline = time.time() + min(float(timeout), _READY_WAIT_MAX)
+        # checked and waited on under the condition, so that a work item
+        # finishing in between cannot be missed
+        with self.ready_cond:
+            while not self.isWorkItemReady(item_name, subindex):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return 0
+                self.ready_cond.wait(min(remaining, _READY_RECHECK_INTERVAL))
+            return 1
+
+    def _notifyReady(self):
+        """
+        Wakes the batch sub items waiting in waitReadyBatch.  Called once PDG
+        has been told about a finished work item, so that they see it.
+        """
+        with self.ready_cond:
+            self.ready_cond.notify_all()
+
+    def _openJournal(self):
+        """
+        Opens the journal in the working dir and collects the work items of
+        the previous session whose jobs are still queued or running on the
+        farm, so that onSchedule can re-attach to them.
+        """
+        self.recovered = {}
+        if not self._jobTemplate()['journal']:
+            self.journal = None
+            return
+
+        path = self.workingDir(True) + '/afanasy_journal.jsonl'
+        if self.journal is None or self.journal.path != path:
+            if self.journal:
+                self.journal.close()
+            self.journal = JobJournal(path)
+
+        items = {}
+        try:
+            items = self.journal.load()
         except:
             import traceback
             traceback.print_exc()
             sys.stderr.flush()
+
+        # ignore work items this session already knows about
+        for item_name in list(items.keys()):
+            if self.registry.record(item_name) is not None:
+                del items[item_name]
+
+        if items:
+            jids = list(set(jid for jid, task, task_count, node_name in items.values()))
+            job_list = af.Cmd().getJobList(ids=jids) or []
+            states = dict((job_info['id'], self._taskState(job_info)) for job_info in job_list)
+            for item_name, (jid, task, task_count, node_name) in items.items():
+                if states.get(jid) in (None, 'ERR'):
+                    continue
+                # the results of a finished job are replayed from its log,
+                # without one it is cooked again
+                if states[jid] == 'DON' and not os.path.exists(self._logPath(item_name)):
+                    continue
+                self.recovered[item_name] = (jid, task, task_count, node_name)
+            logger.debug('Recovered {} of {} work items from {}'.format(
+                len(self.recovered), len(items), path))
+
+        self._compactJournal()
+        self.journal.open()
+
+    def _compactJournal(self):
+        """
+        Rewrites the journal with only the jobs still in flight, including
+        the recovered ones that were not scheduled again yet.  The journal
+        lock is held from the snapshot to the rewrite, so no submission or
+        state change can fall between them.
+        """
+        journal = self.journal
+        jobs = {}
+        with journal.lock:
+            with self.registry.lock:
+                for jid, records in self.registry.jobs.items():
+                    node_name = [record for record in records if record][0].node_name
+                    jobs[jid] = (jid, node_name,
+                        [record.item_name if record else None for record in records])
+                for item_name, (jid, task, task_count, node_name) in self.recovered.items():
+                    if jid not in jobs:
+                        jobs[jid] = (jid, node_name, [None] * task_count)
+                    jobs[jid][2][task] = item_name
+            journal.compact(list(jobs.values()))
+
+    def _reattachWorkItem(self, work_item):
+        """
+        Tracks a work item with the job submitted for it by a previous
+        session instead of submitting it again.  Returns False if there is
+        no such job.
+        """
+        # moved from recovered to the registry in one step for compaction
+        with self.journal.lock if self.journal else self.registry.lock:
+            location = self.recovered.pop(work_item.name, None)
+            if location is None:
+                return False
+            jid, task, task_count, node_name = location
+            self.registry.attach(jid, task, task_count, work_item.name, node_name)
+            self.reattached.add(work_item.name)
+        logger.debug('Re-attaching {} to job {}'.format(work_item.name, jid))
+        work_item.data.setInt("afanasy_jobid", jid, 0)
+        self.next_sweep = 0.0
+        return True
+
+    def _replayLog(self, item_name):
+        """
+        Reports the results and attributes that the job of a re-attached
+        work item wrote to its log, since it sent them to the callback
+        server of the session that submitted it.  Returns False if the log
+        is missing or a result in it cannot be read back.
+        """
+        calls = []
+        try:
+            with open(self._logPath(item_name), 'r') as f:
+                for line in f:
+                    if _LOG_START_RE.match(line):
+                        # results of an earlier attempt
+                        calls = []
+                        continue
+                    match = _LOG_RESULT_RE.match(line)
+                    if match:
+                        name, subindex, data, tag, checksum = match.groups()
+                        data = ast.literal_eval(data)
+                        if isinstance(data, bytes) and not isinstance(data, str):
+                            data = data.decode('utf-8')
+                        calls.append((self.workItemFileResult,
+                            (name, int(subindex), data, tag, int(checksum))))
+                        continue
+                    match = _LOG_ATTR_RE.match(line)
+                    if match:
+                        name, attr_name, values = match.groups()
+                        calls.append((self.workItemSetAttribute,
+                            (name, -1, attr_name, ast.literal_eval(values))))
+        except (IOError, OSError, ValueError, SyntaxError) as err:
+            logger.error('Could not replay the results of {} from its log: {}'.format(
+                item_name, err))
             return False
+
+        logger.debug('Replaying {} results of re-attached {}'.format(len(calls), item_name))
+        for fn, args in calls:
+            fn(*args)
         return True
 
+    def _onJobRemoved(self, id):
+        """
+        Fails all unfinished work items of a job that disappeared from the
+        server.
+        """
+        for record in list(self.registry.job(id) or ()):
+            if record is not None:
+                self.workItemFailed(record.item_name, -1)
+
     def onStopCook(self, cancel):
         """
         Callback invoked by PDG when graph cook ends.
         """
         if self.tick_timer:
             self.tick_timer.cancel()
+        logger.debug('Tick stats: {}'.format(self.tickStats()))
+        logger.debug('Work items in flight: {}'.format(self.registry.stateCounts()))
+        if cancel:
+            with self.pack_lock:
+                self.pack_queue.clear()
+            self._dropQueuedSubmissions()
+        else:
+            self._flushPackedWorkItems(force=True)
+        if self.journal:
+            self._compactJournal()
+            self.journal.close()
+        logger.debug('Submission stats: {}'.format(self.submissionStats()))
+        logger.debug('Job resource usage: {}'.format(self.usage_stats.summary()))
+        self._logStagingSavings()
+        if self.metrics.events is not None:
+            trace_path = '{}/afanasy_trace_{}.json'.format(self.workingDir(True), self.cook_id)
+            self.metrics.dumpTrace(trace_path)
+            logger.debug('Wrote cook trace to {}'.format(trace_path))
+
+        # parms may change before the next cook
+        self.job_template = None
         self._stopSharedServers()
 
         return True
@@ -458,41 +1983,58 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
         """
         Called by CallbackServerMixin when a workitem signals success.
         """
-        logger.debug('Job Succeeded: {}'.format(name))
-        self.onWorkItemSucceeded(name, index, cook_duration)
+        with self.metrics.stage('callback_success'):
+            logger.debug('Job Succeeded: {}'.format(name))
+            if self._transition(name, 'DON'):
+                self.onWorkItemSucceeded(name, index, cook_duration)
+                self._notifyReady()
 
     def workItemFailed(self, name, index, jobid=''):
         """
         Called by CallbackServerMixin when a workitem signals failure.
         """
-        logger.debug('Job Failed: name={}, index={}, jobid={}'.format(name, index, jobid))
-        self.onWorkItemFailed(name, index)
+        with self.metrics.stage('callback_failed'):
+            logger.debug('Job Failed: name={}, index={}, jobid={}'.format(name, index, jobid))
+            if self._transition(name, 'ERR'):
+                self.onWorkItemFailed(name, index)
+                self._notifyReady()
 
     def workItemCancelled(self, name, index, jobid=''):
         """
         Called by CallbackServerMixin when a workitem signals cancelled.
         """
-        logger.debug('Job Cancelled: {}'.format(name))
-        self.onWorkItemCanceled(name, index)
+        with self.metrics.stage('callback_cancelled'):
+            logger.debug('Job Cancelled: {}'.format(name))
+            if self._transition(name, 'CNC'):
+                self.onWorkItemCanceled(name, index)
+                self._notifyReady()
 
     def workItemStartCook(self, name, index, jobid=''):
         """
          Called by CallbackServerMixin when a workitem signals started.
         """
-        logger.debug('Job Start Cook: {}'.format(name))
-        self.onWorkItemStartCook(name, index)
+        with self.metrics.stage('callback_start'):
+            logger.debug('Job Start Cook: {}'.format(name))
+            if self._transition(name, 'RUN'):
+                self.onWorkItemStartCook(name, index)
 
     def workItemFileResult(self, item_name, subindex, result, tag, checksum, jobid=''):
         """
         Called by CallbackServerMixin when a workitem signals file result data reported.
         """
-        self.onWorkItemFileResult(item_name, subindex, result, tag, checksum)
+        with self.metrics.stage('callback_result'):
+            self.onWorkItemFileResult(item_name, subindex, result, tag, checksum)
 
     def workItemSetAttribute(self, item_name, subindex, attr_name, data, jobid=''):
         """
         Called by CallbackServerMixin when a workitem signals simple result data reported.
         """
-        self.onWorkItemSetAttribute(item_name, subindex, attr_name, data)
+        with self.metrics.stage('callback_attr'):
+            if attr_name in UsageStats.ATTRIBUTES and data:
+                record = self.registry.record(item_name)
+                if record:
+                    self.usage_stats.observe(record.node_name, attr_name, float(data[0]))
+            self.onWorkItemSetAttribute(item_name, subindex, attr_name, data)
 
 
     def _stopSharedServers(self):
@@ -527,8 +2069,11 @@ class AfanasyScheduler(CallbackServerMixin, PyScheduler):
             return False
         return True
 
+    def _logPath(self, item_name):
+        return '{}/logs/{}.log'.format(self.tempDir(True), item_name)
+
     def getLogURI(self, work_item):
-        log_path = '{}/logs/{}.log'.format(self.tempDir(True), work_item.name)
+        log_path = self._logPath(work_item.name)
         uri = 'file:///' + log_path
         return uri
 
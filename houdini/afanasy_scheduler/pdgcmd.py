@@ -16,12 +16,19 @@
 #               Not dependent on Houdini install.
 #
 
+import ast
+import atexit
+import errno
+import base64
 import json
 import logging
 import os
+import random
+import re
 import socket
 import subprocess
 import sys
+import threading
 import time
 import xmlrpclib
 import httplib
@@ -88,16 +95,325 @@ def localizePath(deloc_path):
 # to the PDG callback server
 #
 
+# Results are sent to the callback server in MultiCall batches, once
+# RESULT_BATCH_SIZE of them are queued or the oldest one has waited
+# RESULT_BATCH_INTERVAL seconds
+RESULT_BATCH_SIZE = 100
+RESULT_BATCH_INTERVAL = 0.5
+
+# Seconds to wait for the callback server, and how often to retry a call
+# that could not reach it before falling back to stdout-only reporting
+CALLBACK_TIMEOUT = float(os.environ.get('PDG_CALLBACK_TIMEOUT', 30.0))
+CALLBACK_RETRIES = int(os.environ.get('PDG_CALLBACK_RETRIES', 3))
+
+# Seconds a job wrapped by pdgcmd.py waits to connect to the callback server
+# before it starts its command, without retries.  A farm that cannot reach
+# the server goes stdout-only right away instead of waiting out the retries.
+CONNECT_TIMEOUT = float(os.environ.get('PDG_CALLBACK_CONNECT_TIMEOUT', 3.0))
+
+# Seconds a batch sub item waits on the server per wait_ready_batch call,
+# and the poll interval bounds used when the server cannot block
+BATCH_WAIT_TIMEOUT = CALLBACK_TIMEOUT / 2
+BATCH_POLL_MIN = 0.05
+BATCH_POLL_MAX = 2.0
+
+class _TimeoutTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport with a socket timeout.  Keeps its connection open
+    between calls.
+    """
+    def __init__(self, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+class _JsonLinesStream(object):
+    """
+    Persistent connection to the scheduler's JSON lines receiver.  Sends
+    each call as a [method, args...] line; binary arguments become
+    {"text": ...} if they are utf-8 and {"b64": ...} otherwise.
+    """
+    def __init__(self, addr, timeout):
+        host, port = addr.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)), min(timeout, CONNECT_TIMEOUT))
+        self.sock.settimeout(timeout)
+
+    @staticmethod
+    def _encode(arg):
+        if isinstance(arg, xmlrpclib.Binary):
+            try:
+                return {'text': arg.data.decode('utf-8')}
+            except UnicodeDecodeError:
+                return {'b64': base64.b64encode(arg.data).decode('ascii')}
+        return arg
+
+    def send(self, calls):
+        lines = [json.dumps([method] + [self._encode(arg) for arg in args])
+                 for method, args in calls]
+        self.sock.sendall(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def close(self):
+        self.sock.close()
+
+class CallbackClient(object):
+    """
+    Client for the PDG callback server, shared by all callback helpers of a
+    process.  Keeps a pool of keep-alive connections, retries calls that
+    could not reach the server with a jittered backoff, and switches to
+    stdout-only reporting if the server stays unreachable.
+
+    If stream_addr is given, calls that need no reply are sent as JSON lines
+    to the scheduler's receiver there instead of over XML-RPC.
+    """
+    def __init__(self, server_addr, timeout=CALLBACK_TIMEOUT, retries=CALLBACK_RETRIES,
+                 stream_addr=None):
+        self.server_addr = server_addr
+        self.timeout = timeout
+        self.retries = retries
+        self.offline = False
+        self.blocking_wait = True
+        self.jobid = _jobId()
+        self.lock = threading.RLock()
+        self.proxies = []
+        self.queued_calls = []
+        self.flush_timer = None
+        self.stream = None
+        if stream_addr:
+            try:
+                self.stream = _JsonLinesStream(stream_addr, timeout)
+            except socket.error as err:
+                print("WARNING: JSON lines receiver {} unreachable, using XML-RPC: {}".format(
+                    stream_addr, err))
+
+    def _acquire(self):
+        with self.lock:
+            if self.proxies:
+                return self.proxies.pop()
+        return xmlrpclib.ServerProxy('http://' + self.server_addr,
+            transport=_TimeoutTransport(self.timeout), allow_none=True)
+
+    def _release(self, proxy):
+        with self.lock:
+            self.proxies.append(proxy)
+
+    def _send(self, send_fn):
+        """
+        Calls send_fn with a proxy from the pool and returns its result, or
+        None if the server could not be reached
+        """
+        if self.offline:
+            return None
+        for attempt in range(self.retries + 1):
+            proxy = self._acquire()
+            try:
+                result = send_fn(proxy)
+            except (OverflowError, TypeError) as err:
+                # the arguments cannot be marshalled, the connection is fine
+                self._release(proxy)
+                print("ERROR: callback {} failed: {}".format(self.server_addr, err))
+                return None
+            except (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError) as err:
+                # the connection of this proxy is broken, drop it
+                if attempt < self.retries:
+                    time.sleep(0.1 * 2 ** attempt * random.uniform(0.5, 1.5))
+                    continue
+                print("ERROR: callback server {} unreachable, reporting to stdout only: {}".format(
+                    self.server_addr, err))
+                self.offline = True
+                return None
+            self._release(proxy)
+            return result
+
+    def probe(self, timeout=CONNECT_TIMEOUT):
+        """
+        Checks once that the server accepts connections within timeout, and
+        switches to stdout-only reporting if it does not.  Returns True if
+        the server can be reached
+        """
+        if self.offline:
+            return False
+        host, port = self.server_addr.rsplit(':', 1)
+        try:
+            socket.create_connection((host, int(port)), timeout).close()
+        except socket.error as err:
+            print("ERROR: callback server {} unreachable, reporting to stdout only: {}".format(
+                self.server_addr, err))
+            self.offline = True
+            return False
+        return True
+
+    def call(self, method, *args):
+        """
+        Calls method on the callback server right away.  Results queued
+        before are sent first
+        """
+        self.flush()
+        return self._send(lambda proxy: getattr(proxy, method)(*args))
+
+    def notify(self, method, *args):
+        """
+        Sends a call whose result is not needed right away, over the JSON
+        lines stream if there is one
+        """
+        if self.stream is None:
+            self.call(method, *args)
+        else:
+            self.queue(method, *args)
+            self.flush()
+
+    def queue(self, method, *args):
+        """
+        Queues a call, to be sent with the next MultiCall batch
+        """
+        with self.lock:
+            self.queued_calls.append((method, args))
+            if len(self.queued_calls) >= RESULT_BATCH_SIZE:
+                self.flush()
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(RESULT_BATCH_INTERVAL, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        """
+        Sends the queued calls as one MultiCall batch
+        """
+        with self.lock:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            calls = self.queued_calls
+            self.queued_calls = []
+            if not calls:
+                return
+
+            if self.stream:
+                try:
+                    self.stream.send(calls)
+                    return
+                except socket.error as err:
+                    print("WARNING: JSON lines stream failed, using XML-RPC: {}".format(err))
+                    self.stream.close()
+                    self.stream = None
+
+            def send(proxy):
+                multicall = xmlrpclib.MultiCall(proxy)
+                for method, args in calls:
+                    getattr(multicall, method)(*args)
+                return multicall()
+            self._send(send)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_log_files = {}
+
+# Printed once by a command run under execCommand before the first result
+# it leaves to the parent to forward.  Commands that report on their own,
+# like the pdgcmd that ships with Houdini, never print it.
+_FORWARD_ACK = 'PDG_FORWARD_ACK'
+_forward_acknowledged = False
+
+def _jobId():
+    try:
+        return os.environ[os.environ['PDG_JOBID_VAR']]
+    except:
+        return ''
+
+def _forwardingResults():
+    """
+    Returns True if the execCommand running this process forwards the
+    results it prints, and acknowledges that to it the first time
+    """
+    global _forward_acknowledged
+    if not os.environ.get('PDG_FORWARD_RESULTS'):
+        return False
+    if not _forward_acknowledged:
+        print(_FORWARD_ACK)
+        _forward_acknowledged = True
+    return True
+
+def getCallbackClient(server_addr=None):
+    """
+    Returns the shared callback client for server_addr (default
+    $PDG_RESULT_SERVER), or None if there is no server to report to
+    """
+    if not server_addr:
+        server_addr = os.environ.get('PDG_RESULT_SERVER')
+        if not server_addr:
+            return None
+    with _clients_lock:
+        client = _clients.get(server_addr)
+        if client is None:
+            stream_addr = None
+            if server_addr == os.environ.get('PDG_RESULT_SERVER'):
+                stream_addr = os.environ.get('PDG_STREAM_SERVER')
+            client = CallbackClient(server_addr, stream_addr=stream_addr)
+            _clients[server_addr] = client
+        return client
+
+def flushResults(server_addr=None):
+    """
+    Sends the queued results to the callback server, or to all servers if
+    server_addr is None
+    """
+    if server_addr is None:
+        with _clients_lock:
+            clients = list(_clients.values())
+    else:
+        clients = [getCallbackClient(server_addr)]
+    for client in clients:
+        if client:
+            client.flush()
+
+atexit.register(flushResults)
+
+def _itemLogFile(item_name):
+    """
+    Returns the log file of the item, opened once in append mode
+    """
+    log_dir = os.environ['PDG_SHARED_TEMP']
+    item_log_path = os.path.join(log_dir, 'logs', item_name).replace('\\', '/') + '.log'
+    output_file = _log_files.get(item_log_path)
+    if output_file is None:
+        makeDirSafe(os.path.dirname(item_log_path))
+        output_file = open(item_log_path, 'a')
+        _log_files[item_log_path] = output_file
+    return output_file
+
 def execBatchPoll(item_name, subindex, server_addr):
     """
-    Blocks until a batch sub item can begin cooking
+    Blocks until a batch sub item can begin cooking.  Waits on the server
+    when it supports it, otherwise polls with an exponential backoff.
+
+    Raises RuntimeError if there is no callback server or it cannot be
+    reached, since the sub item must not cook without being ready.
     """
-    s = xmlrpclib.ServerProxy('http://'+server_addr)
+    client = getCallbackClient(server_addr)
+    if client is None:
+        raise RuntimeError("no callback server to check if {}[{}] is ready".format(
+            item_name, subindex))
+    delay = BATCH_POLL_MIN
     while True:
-        r = s.check_ready_batch(item_name, subindex)
+        if client.offline:
+            raise RuntimeError("callback server {} unreachable, {}[{}] cannot start".format(
+                client.server_addr, item_name, subindex))
+        if client.blocking_wait:
+            try:
+                r = client.call('wait_ready_batch', item_name, subindex, BATCH_WAIT_TIMEOUT)
+            except xmlrpclib.Fault:
+                client.blocking_wait = False
+                continue
+        else:
+            r = client.call('check_ready_batch', item_name, subindex)
         if r and int(r)==1:
             break
-        time.sleep(0.5)
+        if not client.blocking_wait:
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX)
 
 def execItemFailed(item_name, server_addr, to_stdout = True):
     """
@@ -112,13 +428,33 @@ def execItemFailed(item_name, server_addr, to_stdout = True):
 
     Note: Batch items not supported.
     """
-    try:
-        jobid = os.environ[os.environ['PDG_JOBID_VAR']]
-    except:
-        jobid = ''
+    if to_stdout:
+        print("PDG_FAILED: {};{}".format(item_name, -1))
+
+    client = getCallbackClient(server_addr)
+    if client:
+        client.notify('failed', item_name, client.jobid)
+
+def execItemSucceeded(item_name, server_addr, duration=0.0, to_stdout = True):
+    """
+    Executes an item callback directly to report when an item has succeeded.
+
+    item_name: name of the associated workitem
+    server_addr: callback server in format 'IP:PORT'
+    duration: cook time of the item in seconds
+    to_stdout: also emit status messages to stdout
+
+    Note: Batch items not supported.
+    """
+    if _forwardingResults():
+        print("PDG_SUCCESS: {};{};{}".format(item_name, -1, duration))
+        return
+    if to_stdout:
+        print("PDG_SUCCESS: {};{};{}".format(item_name, -1, duration))
 
-    s = xmlrpclib.ServerProxy('http://' + server_addr)
-    s.failed(item_name, jobid)
+    client = getCallbackClient(server_addr)
+    if client:
+        client.notify('success', item_name, duration, client.jobid)
 
 def execStartCook(item_name, subindex=-1, server_addr="", to_stdout = True):
     """
@@ -128,16 +464,13 @@ def execStartCook(item_name, subindex=-1, server_addr="", to_stdout = True):
     if to_stdout:
         print("PDG_START: {};{}".format(item_name, subindex))
 
-    try:
-        jobid = os.environ[os.environ['PDG_JOBID_VAR']]
-    except:
-        jobid = ''
-    
-    s = xmlrpclib.ServerProxy('http://' + server_addr)
+    client = getCallbackClient(server_addr)
+    if not client:
+        return
     if subindex >= 0:
-        s.start_cook_batch(item_name, subindex, jobid)
+        client.notify('start_cook_batch', item_name, subindex, client.jobid)
     else:
-        s.start_cook(item_name, jobid)
+        client.notify('start_cook', item_name, client.jobid)
 
 def reportResultData(result_data, item_name=None, server_addr=None,
                      result_data_tag="", subindex=-1, and_success=False, to_stdout = True,
@@ -170,27 +503,21 @@ def reportResultData(result_data, item_name=None, server_addr=None,
     if not item_name:
         item_name = os.environ['PDG_ITEM_NAME']
     
-    do_socket = True
-    if not server_addr:
-        try:
-            server_addr = os.environ['PDG_RESULT_SERVER']
-        except KeyError:
-            do_socket = False
+    # under execCommand the parent forwards what we print, and tees it into
+    # the log.  Batch sub item success has no stdout form, so it is sent.
+    forwarded = not (and_success and subindex >= 0) and _forwardingResults()
+    if forwarded:
+        client = None
+        to_stdout = True
+    else:
+        client = getCallbackClient(server_addr)
+    do_socket = client is not None
 
     is_filepath = result_data_tag.startswith('file') or not result_data_tag
-    
-    server_proxy = xmlrpclib.ServerProxy('http://' + server_addr)
 
-    multicall = False
-    proxy = server_proxy
-    if len(result_data_list) > 1:
-        proxy = xmlrpclib.MultiCall(server_proxy)
-        multicall = True
-
-    try:
-        jobid = os.environ[os.environ['PDG_JOBID_VAR']]
-    except:
-        jobid = ''
+    output_file = None
+    if to_stdout and not forwarded:
+        output_file = _itemLogFile(item_name)
 
     for result_data_elem in result_data_list:
         if is_filepath:
@@ -199,49 +526,49 @@ def reportResultData(result_data, item_name=None, server_addr=None,
             if not result_data_elem.startswith('__PDG_DIR__'): 
                 result_data_elem = delocalizePath(result_data_elem)
 
-        log_dir = os.environ['PDG_SHARED_TEMP']
-        item_log_path = os.path.join(log_dir, 'logs', item_name).replace('\\', '/') + '.log'
-
-        def open_output_file():
-            outf = open(item_log_path, 'w')
-            return outf
-
-        output_file = open_output_file()
         if to_stdout:
-            if len(result_data_elem) > 100:
+            if len(result_data_elem) > 100 and not forwarded:
                 print_result_data_elem = repr(result_data_elem)[0:90] + '...('+str(len(result_data_elem))+' bytes)'
             else:
                 print_result_data_elem = repr(result_data_elem)
             print("PDG_RESULT: {};{};{};{};{}".format(item_name, subindex, print_result_data_elem, result_data_tag, hash_code))
-            output_file.write("PDG_RESULT: {};{};{};{};{}".format(item_name, subindex, print_result_data_elem, result_data_tag, hash_code))
+            if output_file:
+                # in full, the scheduler may read results back from the log
+                output_file.write("PDG_RESULT: {};{};{};{};{}\n".format(item_name, subindex, repr(result_data_elem), result_data_tag, hash_code))
             if and_success:
                 print("PDG_SUCCESS: {};{};{}".format(item_name, subindex, duration))
-            output_file.close()
+                if output_file:
+                    output_file.write("PDG_SUCCESS: {};{};{}\n".format(item_name, subindex, duration))
 
-        '''
         if do_socket:
+            if isinstance(result_data_elem, unicode):
+                result_data_elem = result_data_elem.encode('utf-8')
+            result_data_elem = xmlrpclib.Binary(result_data_elem)
             if and_success:
                 if subindex >= 0:
-                    proxy.success_and_result_batch(item_name, xmlrpclib.Binary(result_data_elem),
-                        result_data_tag, subindex, hash_code, duration, jobid)
+                    client.queue('success_and_result_batch', item_name, result_data_elem,
+                        result_data_tag, subindex, hash_code, duration, client.jobid)
                 else:
-                    proxy.success_and_result(item_name, xmlrpclib.Binary(result_data_elem),
-                        result_data_tag, hash_code, duration, jobid)
+                    client.queue('success_and_result', item_name, result_data_elem,
+                        result_data_tag, hash_code, duration, client.jobid)
             else:
                 if subindex >= 0:
-                    proxy.result_batch(item_name, xmlrpclib.Binary(result_data_elem), 
-                        result_data_tag, subindex, hash_code, jobid)
+                    client.queue('result_batch', item_name, result_data_elem,
+                        result_data_tag, subindex, hash_code, client.jobid)
                 else:
-                    proxy.result(item_name, xmlrpclib.Binary(result_data_elem), 
-                        result_data_tag, hash_code, jobid)
-        '''
-    
-    if multicall:
-        proxy()
+                    client.queue('result', item_name, result_data_elem,
+                        result_data_tag, hash_code, client.jobid)
+
+    if output_file:
+        output_file.flush()
+
+    # a finished item must not wait for the next flush
+    if do_socket and and_success:
+        client.flush()
 
     return True
 
-def writeAttribute(attr_name, attr_value, item_name=None, server_addr=None):
+def writeAttribute(attr_name, attr_value, item_name=None, server_addr=None, to_stdout=True):
     """
     Writes attribute data back into a work item in PDG via the callback server.
 
@@ -250,6 +577,7 @@ def writeAttribute(attr_name, attr_value, item_name=None, server_addr=None):
                     if there is no env var it will default to stdout reporting only.
     attr_name:      name of the attribute
     attr_value:     single value or array of string/float/int data
+    to_stdout:      also emit the attribute to stdout
     """
     if not isinstance(attr_value, (list, tuple)):
         attr_value_list = [attr_value]
@@ -264,19 +592,18 @@ def writeAttribute(attr_name, attr_value, item_name=None, server_addr=None):
     if not item_name:
         item_name = os.environ['PDG_ITEM_NAME']
     
-    if not server_addr:
-        server_addr = os.environ['PDG_RESULT_SERVER']
-
-    server_proxy = xmlrpclib.ServerProxy('http://' + server_addr)
-
-    proxy = server_proxy
-    try:
-        jobid = os.environ[os.environ['PDG_JOBID_VAR']]
-    except:
-        jobid = ''
+    forwarded = _forwardingResults()
+    if to_stdout or forwarded:
+        print("PDG_RESULT_ATTR: {};{};{}".format(item_name, attr_name, attr_value_list))
+    if forwarded:
+        return
 
-    print("PDG_RESULT_ATTR: {};{};{}".format(item_name, attr_name, attr_value_list))
-    proxy.write_attr(item_name, attr_name, attr_value_list, jobid)
+    client = getCallbackClient(server_addr)
+    if client and client.stream:
+        # sent in order with the next batch of results
+        client.queue('write_attr', item_name, attr_name, attr_value_list, client.jobid)
+    elif client:
+        client.call('write_attr', item_name, attr_name, attr_value_list, client.jobid)
 
 def reportServerStarted(servername, pid, host, port, proto_type, item_name=None, server_addr=None):
     """
@@ -299,13 +626,8 @@ def reportServerStarted(servername, pid, host, port, proto_type, item_name=None,
     if not server_addr:
         server_addr = os.environ['PDG_RESULT_SERVER']
 
-    server_proxy = xmlrpclib.ServerProxy('http://' + server_addr)
-    try:
-        jobid = os.environ[os.environ['PDG_JOBID_VAR']]
-    except:
-        jobid = ''
-
-    server_proxy.sharedserver_started(sharedserver_message, jobid)
+    client = getCallbackClient(server_addr)
+    client.call('sharedserver_started', sharedserver_message, client.jobid)
     reportResultData(str(host), item_name=item_name,
         server_addr=server_addr, result_data_tag="socket/ip")
     reportResultData(str(port), item_name=item_name,
@@ -318,19 +640,192 @@ def getSharedServerInfo(servername, server_addr=None):
     if not server_addr:
         server_addr = os.environ['PDG_RESULT_SERVER']
 
-    server_proxy = xmlrpclib.ServerProxy('http://' + server_addr)
-    return server_proxy.get_sharedserver_info(servername)
+    return getCallbackClient(server_addr).call('get_sharedserver_info', servername)
 
-def execCommand(command, toolName=None):
+def execJob(command, item_name=None, server_addr=None):
     """
-    Executes a command
+    Executes the command of a work item and reports to PDG when it starts,
+    succeeds or fails, so the scheduler does not have to wait for the
+    farm to notice.
+
+    command:        command line string or argument list
+    item_name:      name of the associated workitem (default $PDG_ITEM_NAME)
+    server_addr:    callback server in format 'IP:PORT' (default $PDG_RESULT_SERVER)
+    """
+    if not item_name:
+        item_name = os.environ['PDG_ITEM_NAME']
+
+    if not server_addr:
+        server_addr = os.environ['PDG_RESULT_SERVER']
+
+    # a farm that cannot reach the server runs the command without waiting
+    # out the callback retries
+    client = getCallbackClient(server_addr)
+    if client:
+        client.probe()
+    execStartCook(item_name, server_addr=server_addr)
+    if 'PDG_SHARED_TEMP' in os.environ:
+        # marks where the results of this attempt start in the log
+        log_file = _itemLogFile(item_name)
+        log_file.write("PDG_START: {};{}\n".format(item_name, -1))
+        log_file.flush()
+    start_time = time.time()
+    usage = {}
+    try:
+        execCommand(command, usage=usage)
+    except SystemExit as exit_err:
+        if exit_err.code:
+            _reportUsage(usage, item_name, server_addr)
+            execItemFailed(item_name, server_addr)
+        raise
+    _reportUsage(usage, item_name, server_addr)
+    execItemSucceeded(item_name, server_addr, time.time() - start_time)
+
+def _reportUsage(usage, item_name, server_addr):
+    """
+    Writes the resource usage measured by execCommand as job_* attributes.
+    Never raises, so that the success or failure of the job is always
+    reported after it.
+    """
+    for key in sorted(usage):
+        try:
+            writeAttribute('job_' + key, usage[key], item_name, server_addr)
+        except Exception as err:
+            print("WARNING: could not report job_{}: {}".format(key, err))
+
+# Lines of a child process that execCommand forwards to PDG as they appear
+_RESULT_LINE_RE = re.compile(r'^PDG_RESULT: ([^;]*);(-?\d+);(.*);([^;]*);(-?\d+)\s*$')
+_ATTR_LINE_RE = re.compile(r'^PDG_RESULT_ATTR: ([^;]*);([^;]*);(.*?)\s*$')
+_SUCCESS_LINE_RE = re.compile(r'^PDG_SUCCESS: ([^;]*);-1;(\S+)\s*$')
+_PROGRESS_LINE_RE = re.compile(r'ALF_PROGRESS\s+\d+%')
+
+# Longest output line read at once, so a tool writing without newlines
+# cannot grow the read buffer without bound
+MAX_LINE_LENGTH = 65536
+
+def _forwardLine(line):
+    """
+    Reports a PDG_RESULT, PDG_RESULT_ATTR or PDG_SUCCESS line printed by a
+    child process to PDG.  Returns True if the line was one of them.
+    """
+    match = _RESULT_LINE_RE.match(line)
+    if match:
+        item_name, subindex, data, tag, hash_code = match.groups()
+        reportResultData(ast.literal_eval(data), item_name, result_data_tag=tag,
+            subindex=int(subindex), to_stdout=False, hash_code=int(hash_code))
+        return True
+    match = _ATTR_LINE_RE.match(line)
+    if match:
+        item_name, attr_name, values = match.groups()
+        writeAttribute(attr_name, ast.literal_eval(values), item_name, to_stdout=False)
+        return True
+    match = _SUCCESS_LINE_RE.match(line)
+    if match:
+        item_name, duration = match.groups()
+        execItemSucceeded(item_name, None, float(duration), to_stdout=False)
+        return True
+    return False
+
+def _streamOutput(process, log_file, forward):
+    """
+    Copies the output of process line by line to stdout and log_file.  If
+    forward is True, the results it reports are forwarded once it has
+    acknowledged that it leaves them to us; results of a command that
+    reports them itself are only copied, so PDG does not get them twice.
+    """
+    acknowledged = False
+    for line in iter(lambda: process.stdout.readline(MAX_LINE_LENGTH), b''):
+        if forward and not acknowledged and line.rstrip() == _FORWARD_ACK:
+            acknowledged = True
+            continue
+        sys.stdout.write(line)
+        if log_file:
+            log_file.write(line)
+        if acknowledged and line.startswith((b'PDG_RESULT', b'PDG_SUCCESS')):
+            try:
+                _forwardLine(line)
+            except (ValueError, SyntaxError):
+                print("WARNING: could not forward {!r}".format(line[:200]))
+            sys.stdout.flush()
+        elif _PROGRESS_LINE_RE.search(line):
+            # the farm parses progress from our output, don't hold it back
+            sys.stdout.flush()
+
+def _waitWithUsage(process):
+    """
+    Waits for process to exit and returns its resource usage, or None where
+    os.wait4 is not available
+    """
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+def execCommand(command, toolName=None, usage=None):
+    """
+    Executes a command, given as a command line string or argument list.
+
+    The output of the command is streamed to stdout and to the log of
+    $PDG_ITEM_NAME.  Results and attributes it prints are reported to PDG
+    as they appear, so that they do not wait for the command to finish.
+
+    If usage is a dict, it is filled with the wall time, user and system
+    CPU time in seconds, and peak RSS and I/O in bytes of the command.
     """
 
     print "Executing command: {}".format(command)
 
+    if isinstance(command, (list, tuple)):
+        args = list(command)
+    else:
+        args = shlex.split(command)
+
+    item_name = os.environ.get('PDG_ITEM_NAME')
+    log_file = None
+    if item_name and 'PDG_SHARED_TEMP' in os.environ:
+        log_file = _itemLogFile(item_name)
+
+    # results the command reports are sent by us rather than by the command,
+    # if it acknowledges PDG_FORWARD_RESULTS.  Python commands are unbuffered
+    # so that their results and progress stream as they are printed.
+    forward = getCallbackClient() is not None
+    env = dict(os.environ)
+    env['PYTHONUNBUFFERED'] = '1'
+    if forward:
+        env['PDG_FORWARD_RESULTS'] = '1'
+
     try:
-        process = subprocess.Popen(shlex.split(command))
-        process.communicate()
+        start_time = time.time()
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, env=env)
+        _streamOutput(process, log_file, forward)
+        rusage = _waitWithUsage(process)
+        if usage is not None:
+            usage['walltime'] = time.time() - start_time
+            if rusage:
+                # ru_maxrss is in bytes on macOS and in kilobytes elsewhere,
+                # block counts are in 512 byte units.  Byte counts are
+                # floats, XML-RPC cannot carry ints of 2 GiB or more.
+                usage['usertime'] = rusage.ru_utime
+                usage['systime'] = rusage.ru_stime
+                usage['maxrss'] = float(rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024))
+                usage['readbytes'] = float(rusage.ru_inblock * 512)
+                usage['writebytes'] = float(rusage.ru_oublock * 512)
+        if log_file:
+            log_file.flush()
+        if forward:
+            flushResults()
         if process.returncode != 0:
             exit(1)
     except subprocess.CalledProcessError as cmd_err:
@@ -347,7 +842,7 @@ def execCommand(command, toolName=None):
         try:
             import distutils.spawn
 
-            executableName = command.split(' ')[0]
+            executableName = args[0]
             if not distutils.spawn.find_executable(executableName):
                 print "ERROR: could not find executable {}".format(executableName)
                 print "Are you sure you have {} installed?".format(toolName or executableName)
@@ -360,3 +855,7 @@ def execCommand(command, toolName=None):
 
 
         exit(1)
+
+if __name__ == '__main__':
+    # Job wrapper: pdgcmd.py <command> [args...]
+    execJob(sys.argv[1:])
@@ -0,0 +1,139 @@
+"""
+Benchmarks the job side callbacks of pdgcmd.py against a local XML-RPC
+server and the scheduler's JSON lines receiver.  pdgcmd.py is Python 2
+code, so run this with the python of a Python 2 Houdini build.
+
+    python bench_callbacks.py [--calls 2000] [--attributes 100000]
+"""
+import os
+import threading
+import time
+
+import SimpleXMLRPCServer
+import SocketServer
+import xmlrpclib
+
+from common import Timer, parseArgs, report, setupPaths
+
+setupPaths('afanasy_scheduler')
+
+import afanasyscheduler
+import pdgcmd
+
+
+class _Handler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    # keep connections open between requests, as pooled clients expect
+    protocol_version = 'HTTP/1.1'
+
+
+class CallbackServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """
+    Threaded XML-RPC server that counts the callbacks it receives.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(
+            self, ('127.0.0.1', 0), _Handler, logRequests=False, allow_none=True)
+        self.register_multicall_functions()
+        self.calls = 0
+        self.lock = threading.Lock()
+        for method in ('write_attr', 'result', 'success_and_result', 'success', 'start_cook'):
+            self.register_function(self.count, method)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addr = '127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self, *args):
+        with self.lock:
+            self.calls += 1
+        return 1
+
+
+def freshProxies(args, server):
+    """
+    One ServerProxy per callback, as pdgcmd used to do.
+    """
+    timer = Timer()
+    for index in range(args.calls):
+        proxy = xmlrpclib.ServerProxy('http://' + server.addr)
+        timer.time(proxy.write_attr, 'item', 'attr', [index], '')
+    timer.stop()
+    report(args, 'xmlrpc/write_attr/fresh-proxy', args.calls, timer)
+
+
+def pooledClient(args, server):
+    timer = Timer()
+    for index in range(args.calls):
+        timer.time(pdgcmd.writeAttribute, 'attr', index, 'item', server.addr, to_stdout=False)
+    timer.stop()
+    report(args, 'xmlrpc/write_attr/pooled', args.calls, timer)
+
+
+def batchedResults(args, server):
+    calls = server.calls
+    timer = Timer()
+    for index in range(args.calls):
+        timer.time(pdgcmd.reportResultData, '/tmp/out.{}.bgeo'.format(index), 'item',
+                   server.addr, 'file/geo', to_stdout=False)
+    pdgcmd.flushResults(server.addr)
+    timer.stop()
+    report(args, 'xmlrpc/result/batched', args.calls, timer,
+           received=server.calls - calls)
+
+
+def jsonLines(args, server):
+    received = [0]
+    done = threading.Event()
+
+    def handle(method, call_args):
+        received[0] += 1
+        if received[0] == args.attributes:
+            done.set()
+
+    receiver = afanasyscheduler.JsonLinesReceiver(handle, '127.0.0.1')
+    receiver.start()
+    client = pdgcmd.CallbackClient(server.addr,
+        stream_addr='127.0.0.1:{}'.format(receiver.port))
+    pdgcmd._clients[server.addr] = client
+
+    timer = Timer()
+    for index in range(args.attributes):
+        pdgcmd.writeAttribute('attr', index, 'item', server.addr, to_stdout=False)
+    client.flush()
+    done.wait(600)
+    timer.stop()
+    report(args, 'jsonl/write_attr', args.attributes, timer, received=received[0])
+
+    client.stream.close()
+    receiver.close()
+    del pdgcmd._clients[server.addr]
+
+
+def xmlrpcAttributes(args, server):
+    calls = server.calls
+    timer = Timer()
+    count = min(args.attributes, args.calls)
+    for index in range(count):
+        pdgcmd.writeAttribute('attr', index, 'item', server.addr, to_stdout=False)
+    timer.stop()
+    report(args, 'xmlrpc/write_attr', count, timer, received=server.calls - calls)
+
+
+def main():
+    args = parseArgs(__doc__, scaled=('calls', 'attributes'), calls=2000, attributes=100000)
+    os.environ['PDG_JOBID_VAR'] = 'PDG_JOBID'
+    os.environ['PDG_JOBID'] = '1'
+
+    server = CallbackServer()
+    freshProxies(args, server)
+    pooledClient(args, server)
+    batchedResults(args, server)
+    xmlrpcAttributes(args, server)
+    jsonLines(args, server)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
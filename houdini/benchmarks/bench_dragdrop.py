@@ -0,0 +1,137 @@
+"""
+Benchmarks dropAccept of externaldragdrop.py: dropping a large list of
+files into OBJ, SOP, COP and CHOP networks, dropping the frames of an
+image sequence, dropping a dozen caches over PACKED_LOAD_SIZE, and
+classifying the files of a large texture folder by extension.  The files are written to a temporary directory, since they are
+probed before the nodes are created.  Probing is also timed with
+--probe-latency seconds added to each file, as slow network storage would,
+on one thread and on the probe pool.
+
+    python bench_dragdrop.py [--files 1000] [--textures 5000] [--probe-latency 0.005]
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from common import Timer, parseArgs, report, setupPaths
+
+setupPaths('drag_drop_files')
+
+import hou
+
+SCENARIOS = (
+    # (name, network, file name pattern)
+    ('obj/bgeo.sc', '/obj', 'shots/sh010/geo/rock_{:04d}.bgeo.sc'),
+    ('sop/abc', '/obj/bench_geo', 'shots/sh010/cache/sim_{:04d}.abc'),
+    ('cop/exr', '/img/bench_cop', 'shots/sh010/plates/plate_{:04d}.exr'),
+    ('chop/wav', '/ch/bench_chop', 'shots/sh010/audio/take_{:04d}.wav'),
+    # frames of one sequence, collapsed into one node
+    ('cop/exr-sequence', '/img/bench_cop', 'shots/sh010/plates/plate.{:04d}.exr'),
+)
+# (name, network, file name pattern, file count, file size) of caches that
+# are loaded packed, written as sparse files
+HEAVY_SCENARIO = ('sop/bgeo.sc-4GB', '/obj/bench_geo',
+                  'shots/sh010/cache/fluid_{:04d}_v001.bgeo.sc', 12, 4 * 1024 ** 3)
+
+# The start of each generated file, by extension
+HEADERS = {
+    '.abc': b'Ogawa\xff\x00\x01',
+    '.exr': b'\x76\x2f\x31\x01\x02\x00\x00\x00',
+    '.sc': b'\x00\x00\x00\x00',
+    '.wav': b'RIFF\x24\x08\x00\x00WAVE',
+}
+
+
+def makeNetworks():
+    hou.reset()
+    hou.node('/obj').createNode('geo', 'bench_geo')
+    hou.node('/img').createNode('img', 'bench_cop')
+    hou.node('/ch').createNode('chopnet', 'bench_chop')
+
+
+def benchDrop(args, externaldragdrop, name, network_path, files):
+    makeNetworks()
+    network = hou.node(network_path)
+    hou.ui.current_editor.setPwd(network)
+    before = len(network.children())
+    hou.STATS.clear()
+
+    timer = Timer()
+    timer.time(externaldragdrop.dropAccept, files)
+    timer.stop()
+    stats = hou.STATS
+    report(args, 'dropAccept/' + name, len(files), timer,
+           created=len(network.children()) - before,
+           paneTabs=stats['paneTabs'], createNode=stats['createNode'],
+           undo_entries=stats['undo_entries'], redraws=stats['redraws'],
+           positions=len(set(tuple(node.position()) for node in network.children())),
+           packed=sum(1 for node in network.children()
+                      if node.parmTemplateGroup().find('loadfull')))
+
+
+def makeFiles(root, pattern, count, size=256):
+    files = []
+    for index in range(count):
+        filename = os.path.join(root, pattern.format(index))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(HEADERS[os.path.splitext(filename)[1]].ljust(256, b'\x00'))
+            f.truncate(size)
+        files.append(filename)
+    return files
+
+
+def benchProbe(args, externaldragdrop, files):
+    probe_file = externaldragdrop.probeFile
+
+    def slowProbeFile(filename):
+        time.sleep(args.probe_latency)
+        return probe_file(filename)
+
+    threads = externaldragdrop.PROBE_THREADS
+    externaldragdrop.probeFile = slowProbeFile
+    try:
+        for count in (1, threads):
+            externaldragdrop.PROBE_THREADS = count
+            result = []
+            timer = Timer()
+            timer.time(externaldragdrop.probeFiles, files, result.extend)
+            timer.stop()
+            report(args, 'probeFiles/threads={}'.format(count),
+                   len(files), timer, failed=sum(1 for probe in result if probe.error))
+    finally:
+        externaldragdrop.probeFile = probe_file
+        externaldragdrop.PROBE_THREADS = threads
+
+
+def main():
+    args = parseArgs(__doc__, scaled=('files', 'textures'), files=1000, textures=5000,
+                     probe_latency=0.005)
+    import externaldragdrop
+
+    root = tempfile.mkdtemp(prefix='bench_dragdrop')
+    try:
+        for name, network_path, pattern in SCENARIOS:
+            files = makeFiles(root, pattern, args.files)
+            benchDrop(args, externaldragdrop, name, network_path, files)
+        benchProbe(args, externaldragdrop, files)
+
+        name, network_path, pattern, count, size = HEAVY_SCENARIO
+        files = makeFiles(root, pattern, count, size)
+        benchDrop(args, externaldragdrop, name, network_path, files)
+    finally:
+        shutil.rmtree(root)
+
+    files = ['/assets/rock/textures/rock_{:04d}.exr'.format(index)
+             for index in range(args.textures)]
+    timer = Timer()
+    for filename in files:
+        timer.time(externaldragdrop.classify, filename)
+    timer.stop()
+    report(args, 'classify/textures', len(files), timer)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Benchmarks the Afanasy scheduler against the in-memory farm of fakes/af.py:
+scheduling work items, polling their jobs and handling job callbacks.
+
+    python bench_scheduler.py [--items 10000] [--latency 0.002]
+"""
+import logging
+import os
+import shutil
+import tempfile
+
+from common import Timer, parseArgs, report, setupPaths
+
+setupPaths('afanasy_scheduler')
+
+import af
+import pdg.scheduler
+
+PARMS = {
+    'address' : '', 'callbackportrange' : 0, 'overrideportrange' : 0,
+    'pdg_workingdir' : 'pdg', 'overrideremoterootpath' : 0, 'remotesharedroot' : '',
+    'job_branch' : '', 'depend_mask' : '', 'depend_mask_global' : '', 'priority' : 99,
+    'max_runtasks' : -1, 'maxperhost' : -1, 'hosts_mask' : '', 'hosts_mask_exclude' : '',
+    'capacity' : 1000, 'minruntime' : 0, 'maxruntime' : 0,
+    # ticks are driven by the benchmark
+    'tickmin' : 3600.0, 'tickmax' : 3600.0,
+}
+
+
+class Node(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Data(object):
+    def setInt(self, name, value, index):
+        pass
+
+
+class WorkItem(object):
+    def __init__(self, node, index):
+        self.node = node
+        self.index = index
+        self.id = index
+        self.name = '{}_{}'.format(node.name, index)
+        self.command = '__PDG_HYTHON__ "__PDG_SCRIPTDIR__/cook.py" --item __PDG_ITEM_NAME__'
+        self.data = Data()
+
+
+def makeScheduler(root_dir, **parms):
+    import afanasyscheduler
+    pdg.scheduler.PyScheduler.PARMS = dict(PARMS, localsharedroot=root_dir, **parms)
+    scheduler = afanasyscheduler.AfanasyScheduler(None, 'afanasyscheduler')
+    scheduler.onStart()
+    scheduler.onStartCook(False, None)
+    return scheduler
+
+
+def closeScheduler(scheduler):
+    scheduler.onStopCook(False)
+    scheduler.onStop()
+    if scheduler.tick_timer:
+        scheduler.tick_timer.cancel()
+
+
+def scheduleItems(args, scenario, root_dir, **parms):
+    af.FARM.reset(latency=args.latency)
+    scheduler = makeScheduler(root_dir, **parms)
+    node = Node('ropgeometry1')
+    items = [WorkItem(node, index) for index in range(args.items)]
+    timer = Timer()
+    for work_item in items:
+        timer.time(scheduler.onSchedule, work_item)
+    # wait for packed and queued submissions
+    scheduler._flushPackedWorkItems(force=True)
+    scheduler._stopSubmitWorkers()
+    timer.stop()
+    report(args, scenario, len(items), timer,
+           jobs=len(af.FARM.jobs), farm_requests=af.FARM.requests)
+    return scheduler
+
+
+def pollUntilDone(args, scenario, scheduler, tasks_per_tick):
+    """
+    Advances the farm by tasks_per_tick tasks between ticks until every job
+    is done, and times each tick.
+    """
+    af.FARM.requests = 0
+    timer = Timer()
+    ticks = 0
+    while not af.FARM.finished() or len(scheduler.registry.records('RUN')) \
+            or len(scheduler.registry.records('RDY')):
+        af.FARM.advance(tasks_per_tick)
+        scheduler.next_sweep = 0.0
+        timer.time(scheduler.tick)
+        ticks += 1
+        if ticks > 100000:
+            break
+    timer.stop()
+    report(args, scenario, ticks, timer, farm_requests=af.FARM.requests,
+           succeeded=scheduler.events['succeeded'])
+
+
+def callbackItems(args, scenario, scheduler):
+    """
+    Reports start and success of every item through the callbacks, as
+    pdgcmd does when jobcallbacks is on.
+    """
+    names = sorted(record.item_name for record in scheduler.registry.records())
+    timer = Timer()
+    for name in names:
+        timer.time(scheduler.workItemStartCook, name, -1)
+        timer.time(scheduler.workItemSucceeded, name, -1, 1.0)
+    timer.stop()
+    report(args, scenario, 2 * len(names), timer, succeeded=scheduler.events['succeeded'])
+
+
+def main():
+    args = parseArgs(__doc__, scaled=('items',), items=10000, threads=4, packsize=100,
+                     latency=0.002)
+
+    root_dir = tempfile.mkdtemp(prefix='bench_scheduler_')
+    pref_dir = os.path.join(root_dir, 'prefs')
+    os.makedirs(os.path.join(pref_dir, 'pdg', 'types'))
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'afanasy_scheduler', 'pdgcmd.py'),
+                os.path.join(pref_dir, 'pdg', 'types'))
+    os.environ['HOUDINI_USER_PREF_DIR'] = pref_dir
+
+    import afanasyscheduler
+    logging.getLogger(afanasyscheduler.__name__).setLevel(logging.WARNING)
+
+    try:
+        scheduler = scheduleItems(args, 'schedule/sync', root_dir,
+                                  submitthreads=0, jobcallbacks=0)
+        pollUntilDone(args, 'poll/{}-per-tick'.format(args.items // 20), scheduler, args.items // 20)
+        closeScheduler(scheduler)
+
+        scheduler = scheduleItems(args, 'schedule/threads={}'.format(args.threads), root_dir,
+                                  submitthreads=args.threads)
+        callbackItems(args, 'callbacks/start+success', scheduler)
+        closeScheduler(scheduler)
+
+        scheduler = scheduleItems(args, 'schedule/packed={}'.format(args.packsize), root_dir,
+                                  submitthreads=0, packitems=1, packsize=args.packsize,
+                                  packinterval=3600.0, jobcallbacks=0)
+        pollUntilDone(args, 'poll/packed', scheduler, args.items // 20)
+        closeScheduler(scheduler)
+    finally:
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmarks dependencyNodes of traversenetwork.py on synthetic SOP networks
+of growing size, and the same queries answered by a DependencyIndex: the
+first query builds the index, then --queries repeat it.  The dependencies
+are then colored one setColor call at a time, and with applyToNodes.  Sizes
+whose predecessor took longer than --max-seconds are skipped.
+
+    python bench_traverse.py [--nodes 100000] [--max-seconds 60] [--queries 1000]
+"""
+import sys
+
+from common import Timer, parseArgs, report, setupPaths
+
+setupPaths('dependency_nodes')
+
+import hou
+import traversenetwork
+
+
+def benchIndex(args, traversenetwork, nodes):
+    index = traversenetwork.DependencyIndex()
+    build = Timer()
+    build.time(index.dependencyNodes, nodes[-1])
+    build.stop()
+    hou.STATS.clear()
+    timer = Timer()
+    for _ in range(args.queries):
+        timer.time(index.dependencyNodes, nodes[-1])
+    timer.stop()
+    report(args, 'DependencyIndex/{}'.format(len(nodes)), args.queries, timer,
+           build_seconds=round(build.seconds, 3), hou_calls=sum(hou.STATS.values()))
+    index.close()
+
+
+def benchApply(args, traversenetwork, nodes):
+    found = traversenetwork.dependencyNodes(nodes[-1])
+    color = hou.Color((0.5, 0.2, 0.2))
+
+    hou.STATS.clear()
+    timer = Timer()
+    for node in found:
+        timer.time(node.setColor, color)
+    timer.stop()
+    report(args, 'setColor/{}'.format(len(nodes)), len(found), timer,
+           undo_entries=hou.STATS['undo_entries'], redraws=hou.STATS['redraws'])
+
+    hou.STATS.clear()
+    timer = Timer()
+    timer.time(traversenetwork.applyToNodes, found, color=(0.5, 0.2, 0.2))
+    timer.stop()
+    report(args, 'applyToNodes/{}'.format(len(nodes)), len(found), timer,
+           undo_entries=hou.STATS['undo_entries'], redraws=hou.STATS['redraws'])
+
+
+def main():
+    args = parseArgs(__doc__, scaled=('nodes',), nodes=100000, max_seconds=60.0,
+                     queries=1000)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+
+    sizes = sorted(set([max(1, args.nodes // 100), max(1, args.nodes // 10), args.nodes]))
+    previous_seconds = 0.0
+    for size in sizes:
+        scenario = 'dependencyNodes/{}'.format(size)
+        if previous_seconds > args.max_seconds:
+            print('{:<36} skipped, previous size took {:.1f}s'.format(scenario, previous_seconds))
+            continue
+
+        hou.reset()
+        nodes = hou.buildSopNetwork(size)
+        hou.STATS.clear()
+        timer = Timer()
+        try:
+            found = len(timer.time(traversenetwork.dependencyNodes, nodes[-1]))
+            error = None
+        except RecursionError as err:
+            found = 0
+            error = type(err).__name__
+        timer.stop()
+        previous_seconds = timer.seconds
+        extra = dict(found=found, hou_calls=sum(hou.STATS.values()))
+        if error:
+            extra['error'] = error
+        report(args, scenario, size, timer, **extra)
+        if not error:
+            benchIndex(args, traversenetwork, nodes)
+            benchApply(args, traversenetwork, nodes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Helpers shared by the benchmarks: puts the stand-in modules and the tools
+on sys.path, and times and reports scenarios.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+HOUDINI_DIR = os.path.dirname(BENCH_DIR)
+
+
+def setupPaths(*tool_dirs):
+    """
+    Makes the stand-ins in fakes/ and the given tool directories, relative
+    to houdini/, importable.
+    """
+    paths = [os.path.join(BENCH_DIR, 'fakes')]
+    paths += [os.path.join(HOUDINI_DIR, tool_dir) for tool_dir in tool_dirs]
+    for path in reversed(paths):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def parseArgs(description, scaled=(), **defaults):
+    """
+    Parses the options shared by all benchmarks, plus an option for each
+    keyword, e.g. items=10000 adds --items.  The options named in scaled
+    are scenario sizes and get multiplied by --scale.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply all scenario sizes, e.g. 0.1 for a quick run')
+    parser.add_argument('--json', metavar='PATH',
+                        help='append the results as JSON lines to PATH')
+    for name, default in sorted(defaults.items()):
+        parser.add_argument('--' + name.replace('_', '-'), dest=name,
+                            type=type(default), default=default)
+    args = parser.parse_args()
+    for name in scaled:
+        setattr(args, name, max(1, int(getattr(args, name) * args.scale)))
+    return args
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Timer(object):
+    """
+    Records the duration of each operation of a scenario.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.start_time = time.time()
+        self.end_time = None
+
+    def time(self, fn, *args, **kwargs):
+        start_time = time.time()
+        result = fn(*args, **kwargs)
+        self.latencies.append(time.time() - start_time)
+        return result
+
+    def stop(self):
+        self.end_time = time.time()
+        return self
+
+    @property
+    def seconds(self):
+        return (self.end_time or time.time()) - self.start_time
+
+
+def report(args, scenario, count, timer, **extra):
+    """
+    Prints the throughput and latency percentiles of a scenario, and appends
+    them to args.json if given.
+    """
+    seconds = timer.seconds
+    result = {
+        'scenario' : scenario,
+        'count' : count,
+        'seconds' : round(seconds, 6),
+        'per_second' : round(count / seconds, 1) if seconds > 0 else None,
+    }
+    if timer.latencies:
+        result.update({
+            'p50_ms' : round(percentile(timer.latencies, 0.5) * 1e3, 4),
+            'p95_ms' : round(percentile(timer.latencies, 0.95) * 1e3, 4),
+            'p99_ms' : round(percentile(timer.latencies, 0.99) * 1e3, 4),
+            'max_ms' : round(max(timer.latencies) * 1e3, 4),
+        })
+    result.update(extra)
+
+    line = '{:<36} {:>8} ops {:>9.3f}s {:>11} ops/s'.format(
+        scenario, count, seconds, result['per_second'])
+    if timer.latencies:
+        line += '  p50 {p50_ms:.3f}ms p95 {p95_ms:.3f}ms p99 {p99_ms:.3f}ms max {max_ms:.3f}ms'.format(**result)
+    if extra:
+        line += '  ' + ' '.join('{}={}'.format(key, extra[key]) for key in sorted(extra))
+    print(line)
+    sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'a') as json_file:
+            json_file.write(json.dumps(result, sort_keys=True) + '\n')
+    return result
@@ -0,0 +1,161 @@
+"""
+Stand-in for the Afanasy python API.
+
+Jobs live in memory in FARM.  FARM.advance() moves their tasks through
+RDY -> RUN -> DON (or ERR), and every request to the server sleeps for
+FARM.latency seconds, so that the scheduler can be measured without a
+farm.
+"""
+import itertools
+import random
+import threading
+import time
+
+
+class Farm(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def advance(self, count):
+        """
+        Moves up to count tasks one state forward, oldest jobs first.
+        Returns the number of tasks moved.
+        """
+        moved = 0
+        with self.lock:
+            for jid in sorted(self.jobs):
+                tasks = self.jobs[jid].tasks
+                for index, state in enumerate(tasks):
+                    if state == 'RDY':
+                        tasks[index] = 'RUN'
+                    elif state == 'RUN':
+                        failed = self.random.random() < self.error_rate
+                        tasks[index] = 'ERR' if failed else 'DON'
+                    else:
+                        continue
+                    moved += 1
+                    if moved >= count:
+                        return moved
+        return moved
+
+    def finished(self):
+        with self.lock:
+            return all(state in ('DON', 'ERR')
+                       for job in self.jobs.values() for state in job.tasks)
+
+
+FARM = Farm()
+
+
+class _Settable(object):
+    """
+    Accepts any setXxx() call, like the job and block settings of af.
+    """
+    def __getattr__(self, name):
+        if name.startswith('set'):
+            return lambda *args: None
+        raise AttributeError(name)
+
+
+class Task(_Settable):
+    def __init__(self, name):
+        self.name = name
+        self.command = None
+        self.env = {}
+
+    def setCommand(self, command):
+        self.command = command
+
+    def setEnv(self, name, value):
+        self.env[name] = value
+
+
+class Block(_Settable):
+    def __init__(self, name, service):
+        self.name = name
+        self.tasks = []
+        self.env = {}
+
+    def setEnv(self, name, value):
+        self.env[name] = value
+
+
+class _FarmJob(object):
+    def __init__(self, jid, job):
+        self.jid = jid
+        self.job = job
+        self.tasks = ['RDY'] * sum(len(block.tasks) for block in job.blocks)
+        self.time_started = int(time.time())
+
+    def info(self):
+        tasks = self.tasks
+        if all(state == 'DON' for state in tasks):
+            state = 'DON'
+        elif 'ERR' in tasks:
+            state = 'ERR'
+        elif 'RUN' in tasks:
+            state = 'RUN'
+        else:
+            state = 'RDY'
+        return {
+            'id' : self.jid,
+            'state' : state,
+            'time_started' : self.time_started,
+            'time_done' : int(time.time()) if state == 'DON' else 0,
+            'blocks' : [{
+                'p_tasks_done' : tasks.count('DON'),
+                'p_tasks_error' : tasks.count('ERR'),
+                'running_tasks_counter' : tasks.count('RUN'),
+                'p_percentage' : 100 * tasks.count('DON') // max(len(tasks), 1),
+            }],
+        }
+
+
+class Job(_Settable):
+    def __init__(self, name):
+        self.name = name
+        self.blocks = []
+
+    def send(self):
+        FARM.request()
+        with FARM.lock:
+            jid = next(FARM.ids)
+            FARM.jobs[jid] = _FarmJob(jid, self)
+        return (True, {'id' : jid})
+
+
+class Cmd(object):
+    def getJobList(self, verbose=False, ids=None):
+        FARM.request()
+        with FARM.lock:
+            return [FARM.jobs[jid].info() for jid in ids if jid in FARM.jobs]
+
+    def getJobInfo(self, jid, verbose=False):
+        FARM.request()
+        with FARM.lock:
+            job = FARM.jobs.get(jid)
+            return [job.info()] if job else None
+
+    def getJobProgress(self, jid, verbose=False):
+        FARM.request()
+        with FARM.lock:
+            job = FARM.jobs.get(jid)
+            if job is None:
+                return None
+            return {'progress' : [[{'state' : state, 'tst' : job.time_started, 'tdn' : 0}
+                                   for state in job.tasks]]}
@@ -0,0 +1,3 @@
+"""
+Stand-in for afcommon, which the scheduler imports but does not use.
+"""
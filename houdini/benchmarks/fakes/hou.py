@@ -0,0 +1,628 @@
+"""
+Stand-in for the parts of the hou module used by the tools in this repo,
+with a generator for synthetic node networks.
+
+Every call that would touch the Houdini scene is counted in STATS, so that
+benchmarks can report how much work a tool asks Houdini to do.
+"""
+import collections
+import contextlib
+import random
+import sys
+
+STATS = collections.Counter()
+
+
+class Color(object):
+    def __init__(self, rgb=(0.0, 0.0, 0.0)):
+        self.rgb_value = tuple(rgb)
+
+    def rgb(self):
+        return self.rgb_value
+
+
+class Vector2(object):
+    def __init__(self, x=0.0, y=0.0):
+        if isinstance(x, (tuple, list, Vector2)):
+            x, y = x[0], x[1]
+        self.x = float(x)
+        self.y = float(y)
+
+    def __getitem__(self, index):
+        return (self.x, self.y)[index]
+
+    def __add__(self, other):
+        return Vector2(self.x + other[0], self.y + other[1])
+
+    def __repr__(self):
+        return '<Vector2 [{}, {}]>'.format(self.x, self.y)
+
+
+class NodeTypeCategory(object):
+    def __init__(self, name):
+        self.category_name = name
+
+    def name(self):
+        return self.category_name
+
+
+_CATEGORIES = dict((name, NodeTypeCategory(name))
+                   for name in ('Object', 'Sop', 'Vop', 'Chop', 'Cop2', 'Lop', 'Manager'))
+
+
+def objNodeTypeCategory():
+    return _CATEGORIES['Object']
+
+
+def sopNodeTypeCategory():
+    return _CATEGORIES['Sop']
+
+
+def vopNodeTypeCategory():
+    return _CATEGORIES['Vop']
+
+
+def chopNodeTypeCategory():
+    return _CATEGORIES['Chop']
+
+
+def cop2NodeTypeCategory():
+    return _CATEGORIES['Cop2']
+
+
+def lopNodeTypeCategory():
+    return _CATEGORIES['Lop']
+
+
+# node type name -> category of its children
+_CHILD_CATEGORIES = {
+    'obj' : 'Object', 'geo' : 'Sop', 'subnet' : 'Sop', 'mat' : 'Vop', 'vopmaterial' : 'Vop',
+    'arnold_vopnet' : 'Vop', 'chopnet' : 'Chop', 'cop2net' : 'Cop2', 'img' : 'Cop2',
+    'stage' : 'Lop', 'lopnet' : 'Lop',
+}
+
+
+class NodeType(object):
+    def __init__(self, name, category):
+        self.type_name = name
+        self.type_category = category
+
+    def name(self):
+        return self.type_name
+
+    def category(self):
+        return self.type_category
+
+    def childTypeCategory(self):
+        return _CATEGORIES.get(_CHILD_CATEGORIES.get(self.type_name))
+
+
+class Parm(object):
+    def __init__(self, node, name):
+        self.node_ref = node
+        self.parm_name = name
+        self.value = ''
+
+    def name(self):
+        return self.parm_name
+
+    def node(self):
+        return self.node_ref
+
+    def set(self, value):
+        STATS['parm_set'] += 1
+        self.value = value
+
+    def eval(self):
+        return self.value
+
+    def evalAsString(self):
+        return str(self.value)
+
+    def unexpandedString(self):
+        return str(self.value)
+
+    def pressButton(self):
+        """
+        Runs the Python callback of the spare button template this parm was
+        made from.
+        """
+        template = self.node_ref.spare_templates[self.parm_name]
+        exec(template.script_callback, {'hou': sys.modules[__name__]},
+             {'kwargs': dict(node=self.node_ref, parm=self)})
+
+
+class scriptLanguage(object):
+    Python = 'Python'
+    Hscript = 'Hscript'
+
+
+class ButtonParmTemplate(object):
+    def __init__(self, name, label, script_callback=None,
+                 script_callback_language=scriptLanguage.Hscript, **kwargs):
+        self.template_name = name
+        self.label = label
+        self.script_callback = script_callback
+        self.script_callback_language = script_callback_language
+
+    def name(self):
+        return self.template_name
+
+
+class ParmTemplateGroup(object):
+    def __init__(self, templates=()):
+        self.templates = list(templates)
+
+    def append(self, template):
+        self.templates.append(template)
+
+    def find(self, name):
+        for template in self.templates:
+            if template.name() == name:
+                return template
+        return None
+
+
+class nodeEventType(object):
+    BeingDeleted = 'BeingDeleted'
+    NameChanged = 'NameChanged'
+    InputRewired = 'InputRewired'
+    ParmTupleChanged = 'ParmTupleChanged'
+    ChildCreated = 'ChildCreated'
+    ChildDeleted = 'ChildDeleted'
+
+
+class nodeFlag(object):
+    Bypass = 'Bypass'
+    Display = 'Display'
+    Render = 'Render'
+    Template = 'Template'
+    Highlight = 'Highlight'
+
+
+class severityType(object):
+    Message = 'Message'
+    ImportantMessage = 'ImportantMessage'
+    Warning = 'Warning'
+    Error = 'Error'
+    Fatal = 'Fatal'
+
+
+class updateMode(object):
+    AutoUpdate = 'AutoUpdate'
+    OnMouseUp = 'OnMouseUp'
+    Manual = 'Manual'
+
+
+_SCENE = dict(undo_depth=0, update_mode=updateMode.AutoUpdate)
+
+
+def _sceneChanged():
+    """
+    Counts the undo entry and the network editor redraw of one change.
+    Changes inside an undo group share its entry, and changes in Manual
+    update mode are redrawn once the mode is switched back.
+    """
+    if not _SCENE['undo_depth']:
+        STATS['undo_entries'] += 1
+    if _SCENE['update_mode'] != updateMode.Manual:
+        STATS['redraws'] += 1
+
+
+def updateModeSetting():
+    return _SCENE['update_mode']
+
+
+def setUpdateMode(mode):
+    if _SCENE['update_mode'] == updateMode.Manual and mode != updateMode.Manual:
+        STATS['redraws'] += 1
+    _SCENE['update_mode'] = mode
+
+
+def isUIAvailable():
+    return True
+
+
+class OpNode(object):
+    def __init__(self, parent, type_name, name):
+        self.parent_node = parent
+        self.node_name = name
+        if parent is None:
+            category = _CATEGORIES['Manager']
+        else:
+            category = parent.type().childTypeCategory()
+        self.node_type = NodeType(type_name, category)
+        self.child_nodes = collections.OrderedDict()
+        self.input_nodes = []
+        self.output_nodes = []
+        self.referenced = []
+        self.referencing = []
+        self.parms = {}
+        self.spare_templates = collections.OrderedDict()
+        self.node_color = Color()
+        self.node_position = Vector2()
+        self.selected = False
+        self.flags = {}
+        self.node_comment = ''
+        self.locked_hda = False
+        self.callbacks = []
+
+    # identity
+    def name(self):
+        return self.node_name
+
+    def path(self):
+        if self.parent_node is None:
+            return ''
+        return self.parent_node.path() + '/' + self.node_name
+
+    def type(self):
+        return self.node_type
+
+    def parent(self):
+        return self.parent_node
+
+    def isInsideLockedHDA(self):
+        return self.locked_hda
+
+    # connections
+    def inputs(self):
+        STATS['inputs'] += 1
+        return tuple(self.input_nodes)
+
+    def outputs(self):
+        STATS['outputs'] += 1
+        return tuple(self.output_nodes)
+
+    def setInput(self, index, node):
+        while len(self.input_nodes) <= index:
+            self.input_nodes.append(None)
+        old = self.input_nodes[index]
+        if old is not None:
+            old.output_nodes.remove(self)
+        self.input_nodes[index] = node
+        if node is not None:
+            node.output_nodes.append(self)
+        self._event(nodeEventType.InputRewired, input_index=index)
+
+    def inputAncestors(self):
+        STATS['inputAncestors'] += 1
+        ancestors = []
+        seen = set([self])
+        stack = [self]
+        while stack:
+            for node in stack.pop().input_nodes:
+                if node is not None and node not in seen:
+                    seen.add(node)
+                    ancestors.append(node)
+                    stack.append(node)
+        return tuple(ancestors)
+
+    def addReference(self, node):
+        """
+        Makes a parm of this node reference node, as a channel reference
+        would.
+        """
+        self.referenced.append(node)
+        node.referencing.append(self)
+        self._event(nodeEventType.ParmTupleChanged, parm_tuple=None)
+
+    def references(self, include_children=True):
+        STATS['references'] += 1
+        return tuple(self.referenced)
+
+    def dependents(self, include_children=True):
+        STATS['dependents'] += 1
+        return tuple(self.referencing)
+
+    # appearance
+    def setColor(self, color):
+        STATS['setColor'] += 1
+        _sceneChanged()
+        self.node_color = color
+
+    def color(self):
+        return self.node_color
+
+    def setSelected(self, on, clear_all_selected=False):
+        STATS['setSelected'] += 1
+        _sceneChanged()
+        if clear_all_selected:
+            for node in _allNodes():
+                node.selected = False
+        self.selected = on
+
+    def isSelected(self):
+        return self.selected
+
+    def setComment(self, comment):
+        STATS['setComment'] += 1
+        self.node_comment = comment
+
+    def comment(self):
+        return self.node_comment
+
+    def setGenericFlag(self, flag, on):
+        STATS['setGenericFlag'] += 1
+        _sceneChanged()
+        self.flags[flag] = on
+
+    def isGenericFlagSet(self, flag):
+        return self.flags.get(flag, False)
+
+    def position(self):
+        return self.node_position
+
+    def setPosition(self, position):
+        STATS['setPosition'] += 1
+        self.node_position = Vector2(position)
+
+    def moveToGoodPosition(self):
+        STATS['moveToGoodPosition'] += 1
+        return self.node_position
+
+    # parms
+    def parm(self, name):
+        parm = self.parms.get(name)
+        if parm is None:
+            parm = self.parms[name] = Parm(self, name)
+        return parm
+
+    def setParms(self, values):
+        STATS['setParms'] += 1
+        for name, value in values.items():
+            self.parm(name).value = value
+
+    def parmTemplateGroup(self):
+        return ParmTemplateGroup(self.spare_templates.values())
+
+    def setParmTemplateGroup(self, group):
+        STATS['setParmTemplateGroup'] += 1
+        self.spare_templates = collections.OrderedDict(
+            (template.name(), template) for template in group.templates)
+
+    # children
+    def children(self):
+        return tuple(self.child_nodes.values())
+
+    def node(self, path):
+        node = self
+        for part in path.strip('/').split('/'):
+            node = node.child_nodes.get(part)
+            if node is None:
+                return None
+        return node
+
+    def createNode(self, type_name, node_name=None, run_init_scripts=True):
+        STATS['createNode'] += 1
+        _sceneChanged()
+        category = self.type().childTypeCategory()
+        node_class = _NODE_CLASSES.get(category.name() if category else None, OpNode)
+        base = node_name or type_name
+        name = base
+        index = 1
+        while name in self.child_nodes:
+            name = '{}{}'.format(base, index)
+            index += 1
+        node = node_class(self, type_name, name)
+        self.child_nodes[name] = node
+        # a default geo object comes with a file SOP
+        if type_name == 'geo':
+            node.child_nodes['file1'] = SopNode(node, 'file', 'file1')
+        self._event(nodeEventType.ChildCreated, child_node=node)
+        return node
+
+    def destroy(self):
+        STATS['destroy'] += 1
+        self._event(nodeEventType.BeingDeleted)
+        for node in list(self.output_nodes):
+            node.input_nodes = [None if n is self else n for n in node.input_nodes]
+        for node in self.input_nodes:
+            if node is not None:
+                node.output_nodes.remove(self)
+        for node in self.referenced:
+            node.referencing.remove(self)
+        for node in self.referencing:
+            node.referenced.remove(self)
+        if self.parent_node is not None:
+            del self.parent_node.child_nodes[self.node_name]
+            self.parent_node._event(nodeEventType.ChildDeleted, child_node=self)
+
+    # events
+    def addEventCallback(self, event_types, callback):
+        self.callbacks.append((tuple(event_types), callback))
+
+    def removeEventCallback(self, event_types, callback):
+        self.callbacks = [(types, fn) for types, fn in self.callbacks
+                          if not (fn == callback and types == tuple(event_types))]
+
+    def removeAllEventCallbacks(self):
+        self.callbacks = []
+
+    def _event(self, event_type, **kwargs):
+        for types, callback in self.callbacks:
+            if event_type in types:
+                callback(event_type=event_type, node=self, **kwargs)
+
+    def __repr__(self):
+        return '<hou.{} {}>'.format(type(self).__name__, self.path())
+
+
+class Node(OpNode):
+    pass
+
+
+class ObjNode(OpNode):
+    pass
+
+
+class SopNode(OpNode):
+    pass
+
+
+class VopNode(OpNode):
+    pass
+
+
+class ChopNode(OpNode):
+    pass
+
+
+class CopNode(OpNode):
+    pass
+
+
+_NODE_CLASSES = {'Object' : ObjNode, 'Sop' : SopNode, 'Vop' : VopNode,
+                 'Chop' : ChopNode, 'Cop2' : CopNode}
+
+
+_ROOT = OpNode(None, 'root', '')
+_ROOT.node_type = NodeType('obj', _CATEGORIES['Manager'])
+for _name, _type in (('obj', 'obj'), ('mat', 'mat'), ('ch', 'chopnet'), ('img', 'img'), ('stage', 'stage')):
+    _ROOT.child_nodes[_name] = OpNode(_ROOT, _type, _name)
+del _name, _type
+
+
+def node(path):
+    return _ROOT.node(path)
+
+
+def _allNodes():
+    stack = [_ROOT]
+    while stack:
+        current = stack.pop()
+        yield current
+        stack.extend(current.child_nodes.values())
+
+
+def selectedNodes():
+    return tuple(node for node in _allNodes() if node.selected)
+
+
+def clearAllSelected():
+    STATS['clearAllSelected'] += 1
+    _sceneChanged()
+    for node in _allNodes():
+        node.selected = False
+
+
+def reset():
+    """
+    Removes every node below the managers and clears STATS.
+    """
+    for manager in _ROOT.child_nodes.values():
+        manager.child_nodes.clear()
+        manager.callbacks = []
+    STATS.clear()
+    _SCENE.update(undo_depth=0, update_mode=updateMode.AutoUpdate)
+    ui.current_editor.current_path = '/obj'
+    ui.current_editor.cursor = Vector2()
+
+
+# user interface
+class PaneTab(object):
+    def isCurrentTab(self):
+        return True
+
+
+class NetworkEditor(PaneTab):
+    def __init__(self):
+        self.current_path = '/obj'
+        self.cursor = Vector2()
+
+    def pwd(self):
+        return node(self.current_path)
+
+    def setPwd(self, network):
+        self.current_path = network.path()
+
+    def cursorPosition(self):
+        return self.cursor
+
+
+class _Ui(object):
+    def __init__(self):
+        self.current_editor = NetworkEditor()
+        self.pane_tabs = [PaneTab(), self.current_editor]
+
+    def paneTabs(self):
+        STATS['paneTabs'] += 1
+        return tuple(self.pane_tabs)
+
+    def paneTabOfType(self, pane_type):
+        for pane in self.pane_tabs:
+            if isinstance(pane, NetworkEditor):
+                return pane
+        return None
+
+    def displayMessage(self, text, **kwargs):
+        STATS['displayMessage'] += 1
+
+
+ui = _Ui()
+
+
+class _Undos(object):
+    @contextlib.contextmanager
+    def group(self, label):
+        STATS['undo_groups'] += 1
+        _SCENE['undo_depth'] += 1
+        try:
+            yield
+        finally:
+            _SCENE['undo_depth'] -= 1
+        if not _SCENE['undo_depth']:
+            STATS['undo_entries'] += 1
+
+    @contextlib.contextmanager
+    def disabler(self):
+        yield
+
+
+undos = _Undos()
+
+
+class _HipFile(object):
+    def importFBX(self, file_path, **kwargs):
+        STATS['importFBX'] += 1
+        return _ROOT.node('obj').createNode('subnet', 'fbx_import'), ''
+
+
+hipFile = _HipFile()
+
+
+class _Hda(object):
+    def installFile(self, file_path, **kwargs):
+        STATS['installFile'] += 1
+
+
+hda = _Hda()
+
+
+class OperationFailed(Exception):
+    pass
+
+
+# synthetic networks
+def buildSopNetwork(count, window=8, max_inputs=2, reference_ratio=0.05, seed=0):
+    """
+    Builds a geo object with count SOPs under /obj.  Each SOP is wired to up
+    to max_inputs of the window SOPs created before it, and reference_ratio
+    of the SOPs reference the parms of a random earlier SOP.  Returns the
+    SOPs in creation order.
+    """
+    rand = random.Random(seed)
+    geo = node('/obj').createNode('geo', 'bench_geo')
+    for child in geo.children():
+        child.destroy()
+    nodes = []
+    for index in range(count):
+        sop = geo.createNode('null', 'null{}'.format(index))
+        if nodes:
+            earlier = nodes[max(0, index - window):]
+            for input_index in range(rand.randint(1, max_inputs)):
+                sop.setInput(input_index, rand.choice(earlier))
+            if rand.random() < reference_ratio:
+                sop.addReference(rand.choice(nodes))
+        nodes.append(sop)
+    return nodes
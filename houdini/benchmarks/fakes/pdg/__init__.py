@@ -0,0 +1,9 @@
+"""
+Stand-in for the parts of the pdg module the Afanasy scheduler uses.
+"""
+
+
+class scheduleResult(object):
+    Succeeded = 'Succeeded'
+    Failed = 'Failed'
+    CookSucceeded = 'CookSucceeded'
@@ -0,0 +1,22 @@
+"""
+Stand-in for the PDG callback server mixin.  No server is started; the
+benchmarks call the workItem* callbacks directly.
+"""
+
+
+class CallbackServerMixin(object):
+    def __init__(self, is_batch):
+        self.server = None
+        self.running = False
+
+    def startCallbackServer(self):
+        self.running = True
+
+    def stopCallbackServer(self):
+        self.running = False
+
+    def isCallbackServerRunning(self):
+        return self.running
+
+    def workItemResultServerAddr(self):
+        return '127.0.0.1:0'
@@ -0,0 +1,83 @@
+"""
+Stand-in for pdg.scheduler.PyScheduler.  Parms come from PyScheduler.PARMS
+and everything reported to PDG is counted in PyScheduler.events.
+"""
+import collections
+import os
+
+
+class _Parm(object):
+    def __init__(self, value):
+        self.value = value
+
+    def evaluateString(self):
+        return str(self.value)
+
+    def evaluateInt(self):
+        return int(self.value)
+
+    def evaluateFloat(self):
+        return float(self.value)
+
+
+class PyScheduler(object):
+    PARMS = {}
+
+    def __init__(self, scheduler, name):
+        self.parms = dict(self.PARMS)
+        self.events = collections.Counter()
+        self.local_wd = None
+        self.remote_wd = None
+
+    def __getitem__(self, name):
+        if name not in self.parms:
+            raise KeyError(name)
+        return _Parm(self.parms[name])
+
+    def setWorkingDir(self, local_wd, remote_wd):
+        self.local_wd = local_wd
+        self.remote_wd = remote_wd
+
+    def workingDir(self, local):
+        return self.local_wd if local else self.remote_wd
+
+    def tempDir(self, local):
+        return self.workingDir(local) + '/pdgtemp'
+
+    def scriptDir(self, local):
+        return self.tempDir(local) + '/scripts'
+
+    def createJobDirsAndSerializeWorkItems(self, work_item):
+        pass
+
+    def isWorkItemReady(self, name, index):
+        return 1
+
+    def getSharedServers(self):
+        return []
+
+    def onWorkItemSucceeded(self, name, index, cook_duration):
+        self.events['succeeded'] += 1
+
+    def onWorkItemFailed(self, name, index):
+        self.events['failed'] += 1
+
+    def onWorkItemCanceled(self, name, index):
+        self.events['cancelled'] += 1
+
+    def onWorkItemStartCook(self, name, index):
+        self.events['started'] += 1
+
+    def onWorkItemFileResult(self, name, index, result, tag, checksum):
+        self.events['results'] += 1
+
+    def onWorkItemSetAttribute(self, name, index, attr_name, data):
+        self.events['attributes'] += 1
+
+
+def evaluateParamOr(node, name, default):
+    return default
+
+
+def convertEnvMapToUTF8(env):
+    return env
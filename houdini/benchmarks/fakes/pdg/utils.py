@@ -0,0 +1,5 @@
+import os
+
+
+def expand_vars(value):
+    return os.path.expandvars(value)
@@ -0,0 +1,3 @@
+"""
+Stand-in for pdgjob.pdgcmd, which the scheduler imports but does not call.
+"""
@@ -0,0 +1,3 @@
+"""
+Stand-in for services.service, which the scheduler imports but does not use.
+"""
@@ -1,5 +1,5 @@
 import hou
-from typing import List
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 
 def isSopNode(node: hou.OpNode) -> bool:
@@ -7,33 +7,188 @@ def isSopNode(node: hou.OpNode) -> bool:
     return isinstance(node, hou.SopNode) and not node.isInsideLockedHDA()
 
 
-def traverseNetwork(node: hou.OpNode, nodes: List[hou.OpNode]):
-    """Recursively traverses all dependencies including references,
-    parameters and incoming connections."""
+def linkedNodes(node: hou.OpNode,
+                cache: Optional[Dict[hou.OpNode, Tuple[hou.OpNode, ...]]] = None
+                ) -> Tuple[hou.OpNode, ...]:
+    """Returns the incoming connections of the node, followed by the SOP
+    nodes that depend on it or that it references. Pass the same cache
+    dict to repeated queries to look up each node only once."""
+    if cache is not None:
+        linked = cache.get(node)
+        if linked is not None:
+            return linked
+
+    dependents = filter(isSopNode, (*node.dependents(False), *node.references(False)))
+    linked = tuple(node for node in dict.fromkeys((*node.inputs(), *dependents)) if node)
+    if cache is not None:
+        cache[node] = linked
+    return linked
+
+
+def traverseNetwork(node: hou.OpNode, nodes: List[hou.OpNode],
+                    visited: Optional[Set[hou.OpNode]] = None,
+                    cache: Optional[Dict[hou.OpNode, Tuple[hou.OpNode, ...]]] = None):
+    """Traverses all dependencies including references, parameters and
+    incoming connections depth first, appending the nodes not yet in nodes
+    in the order they are found. Uses a worklist instead of recursion, so
+    deep networks cannot hit the recursion limit."""
     if not node:
         return
+    if visited is None:
+        visited = set(nodes)
 
-    curr_node = None
-    dependents = set(filter(isSopNode, (*node.dependents(False), *node.references(False))))
-    for node in (*node.inputs(), *dependents):
-        if node and not node in nodes:
-            nodes.append(node)
-            curr_node = node
-            traverseNetwork(curr_node, nodes)
+    stack = [iter(linkedNodes(node, cache))]
+    while stack:
+        for curr_node in stack[-1]:
+            if curr_node not in visited:
+                visited.add(curr_node)
+                nodes.append(curr_node)
+                stack.append(iter(linkedNodes(curr_node, cache)))
+                break
+        else:
+            stack.pop()
 
 
-def dependencyNodes(node: hou.OpNode) -> List[hou.ObjNode]:
+def dependencyNodes(node: hou.OpNode,
+                    cache: Optional[Dict[hou.OpNode, Tuple[hou.OpNode, ...]]] = None
+                    ) -> List[hou.ObjNode]:
     """Returns all nodes that are dependencies of the given node."""
     nodes = []
+    visited = set()
     for node in (node, *node.inputAncestors()):
-        if not node in nodes:
+        if not node in visited:
+            visited.add(node)
             nodes.append(node)
-        traverseNetwork(node, nodes)
+        traverseNetwork(node, nodes, visited, cache)
     return nodes
 
 
-# Example usage
-color = (0.5, 0.2, 0.20)
-node = hou.selectedNodes()[0]
-for node in dependencyNodes(node):
-    node.setColor(hou.Color(color))
+
+class DependencyIndex:
+    """Keeps the links of every node it has seen, so closure queries do not
+    walk the network through hou again. Node event callbacks keep the index
+    current: a rewired input, a changed parm or a deleted node drops the
+    links of the node and of its neighbours, and the cached closures.
+    Changes made from networks the index has not visited are not seen, call
+    clear() after those."""
+
+    EVENT_TYPES = (hou.nodeEventType.InputRewired,
+                   hou.nodeEventType.ParmTupleChanged,
+                   hou.nodeEventType.BeingDeleted)
+
+    def __init__(self):
+        self.links: Dict[hou.OpNode, Tuple[hou.OpNode, ...]] = {}
+        self.closures: Dict[hou.OpNode, Tuple[hou.OpNode, ...]] = {}
+        self.linked_from: Dict[hou.OpNode, Set[hou.OpNode]] = {}
+        self.watched: Set[hou.OpNode] = set()
+        self.parents: Set[hou.OpNode] = set()
+
+    def dependencyNodes(self, node: hou.OpNode) -> Tuple[hou.OpNode, ...]:
+        """Returns the same nodes as dependencyNodes(node), from the index."""
+        closure = self.closures.get(node)
+        if closure is None:
+            nodes = [node]
+            traverseNetwork(node, nodes, cache=self.links)
+            for curr_node in nodes:
+                self.link(curr_node, self.links[curr_node])
+                self.watch(curr_node)
+            closure = self.closures[node] = tuple(nodes)
+        return closure
+
+    def watch(self, node: hou.OpNode):
+        """Registers the event callbacks of the node and of all its siblings,
+        as wiring or referencing an unwatched node changes the links of the
+        nodes it points to. New children of the network are watched too."""
+        if node in self.watched:
+            return
+        node.addEventCallback(self.EVENT_TYPES, self.onNodeEvent)
+        self.watched.add(node)
+        parent = node.parent()
+        if parent is not None and parent not in self.parents:
+            parent.addEventCallback((hou.nodeEventType.ChildCreated,), self.onChildCreated)
+            self.parents.add(parent)
+            for child in parent.children():
+                self.watch(child)
+
+    def onChildCreated(self, event_type, node, child_node=None, **kwargs):
+        if child_node is not None:
+            self.watch(child_node)
+
+    def onNodeEvent(self, event_type, node, **kwargs):
+        deleted = event_type == hou.nodeEventType.BeingDeleted
+        old_links = self.links.pop(node, None)
+        new_links = linkedNodes(node)
+        if not deleted:
+            self.link(node, new_links)
+            if new_links == old_links:
+                return
+
+        # the neighbours may list the node among their own links
+        for curr_node in {*(old_links or ()), *new_links, *self.linked_from.pop(node, ())}:
+            self.links.pop(curr_node, None)
+        if deleted:
+            self.watched.discard(node)
+        self.closures.clear()
+
+    def link(self, node: hou.OpNode, links: Tuple[hou.OpNode, ...]):
+        self.links[node] = links
+        for curr_node in links:
+            self.linked_from.setdefault(curr_node, set()).add(node)
+
+    def clear(self):
+        """Forgets all links and closures, keeping the callbacks."""
+        self.links.clear()
+        self.linked_from.clear()
+        self.closures.clear()
+
+    def close(self):
+        """Removes the event callbacks and forgets everything."""
+        for node in self.watched:
+            node.removeEventCallback(self.EVENT_TYPES, self.onNodeEvent)
+        for node in self.parents:
+            node.removeEventCallback((hou.nodeEventType.ChildCreated,), self.onChildCreated)
+        self.watched.clear()
+        self.parents.clear()
+        self.clear()
+
+
+def applyToNodes(nodes: Iterable[hou.OpNode],
+                 color: Optional[Tuple[float, float, float]] = None,
+                 select: bool = False,
+                 flag: Optional[hou.nodeFlag] = None, flag_value: bool = True,
+                 dry_run: bool = False,
+                 label: str = "Highlight dependencies") -> List[str]:
+    """Sets the color, the selection and a flag of the nodes in one undo
+    group, with the update mode set to Manual so the changes are redrawn
+    once. Selecting clears the previous selection first. Returns the paths
+    of the nodes; with dry_run nothing is changed, which suits hython."""
+    nodes = list(nodes)
+    paths = [node.path() for node in nodes]
+    if dry_run or not nodes:
+        return paths
+
+    hou_color = hou.Color(color) if color is not None else None
+    update_mode = hou.updateModeSetting()
+    hou.setUpdateMode(hou.updateMode.Manual)
+    try:
+        with hou.undos.group(label):
+            if select:
+                hou.clearAllSelected()
+            for node in nodes:
+                if hou_color is not None:
+                    node.setColor(hou_color)
+                if select:
+                    node.setSelected(True)
+                if flag is not None:
+                    node.setGenericFlag(flag, flag_value)
+    finally:
+        hou.setUpdateMode(update_mode)
+    return paths
+
+
+# Example usage, when run as a script: colors the dependencies of the
+# selected nodes
+if __name__ == '__main__':
+    color = (0.5, 0.2, 0.20)
+    for node in hou.selectedNodes():
+        applyToNodes(dependencyNodes(node), color=color)
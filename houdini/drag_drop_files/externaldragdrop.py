@@ -1,4 +1,5 @@
-import os, re
+import collections, math, os, re
+from multiprocessing.pool import ThreadPool
 
 import hou
 from type_extensions import *
@@ -7,9 +8,39 @@ from nodes_color import *
 
 position = None
 
-def cursorPosition(network):
-	global position
-	position = network.cursorPosition()
+# Spacing of the grid the dropped files are laid out on
+GRID_SPACING = (2.5, -1.0)
+# Wire the SOPs of a drop into a merge below the grid
+MERGE_DROPPED_SOPS = False
+
+# Threads that stat and read the headers of the dropped files
+PROBE_THREADS = 16
+HEADER_SIZE = 32
+SIGNATURES = ((b'\x1f\x8b', 'gzip'),
+			  (b'BZh', 'bzip2'),
+			  (b'\xfd7zXZ\x00', 'xz'),
+			  (b'\x5d\x00\x00', 'lzma'),
+			  (b'Ogawa', 'alembic'),
+			  (b'\x89HDF\r\n\x1a\n', 'alembic'),
+			  (b' BDV', 'vdb'),
+			  (b'Kaydara FBX Binary', 'fbx'))
+# The signatures that files with these extensions must start with
+EXPECTED_SIGNATURES = (('gz', ('gzip',)),
+					   ('.bz2', ('bzip2',)),
+					   ('.lzma', ('xz', 'lzma')),
+					   ('.abc', ('alembic',)),
+					   ('.vdb', ('vdb',)))
+
+Probe = collections.namedtuple('Probe', 'filename size signature error')
+
+# Geometry files from this size on are loaded as packed primitives drawn as
+# bounding boxes, None loads every file in full
+PACKED_LOAD_SIZE = 512 * 1024 * 1024
+# The values of the parms of each loader for a packed and a full load
+PACKED_LOAD_PARMS = {'file': {'loadtype': ('delayed', 'full'),
+							  'viewportlod': ('box', 'full')},
+					 'alembic': {'loadmode': ('alembic', 'houdini'),
+								 'viewportlod': ('box', 'full')}}
 
 
 def getNetworkEditor():
@@ -20,50 +51,206 @@ def getNetworkEditor():
     return editors, ctx, type_ctx
 
 
-def matchTypes(extensions):
-	return re.compile(r'({})$'.format('|'.join(re.escape(x) for x in extensions)))
-
+CATEGORIES = (('geo', GEO_EXTENSIONS),
+			  ('image', IMAGE_EXTENSIONS),
+			  ('chan', CHAN_EXTENSIONS),
+			  ('asset', ASSET_EXTENSIONS))
+
+WHITESPACE = re.compile(r'\s+')
+# The frame number that ends a file name, before the extension, as in
+# name.1001.exr. name_1001.exr is only read as a UDIM tile, since names like
+# tree_01.obj are usually separate files.
+FRAME_NUMBER = re.compile(r'(.*\.)(\d+)$', re.S)
+UDIM_NUMBER = re.compile(r'(.*[._])(\d{4})$', re.S)
+FRAME_TOKEN = re.compile(r'[._]?(\$F\d*|<UDIM>)')
+
+# Categories whose files are collapsed into one node per sequence
+SEQUENCE_CATEGORIES = ('image', 'geo')
+# Model formats are usually numbered assets rather than frames, and
+# importFBX cannot read a frame token
+SEQUENCE_EXCLUDED_EXTENSIONS = ('.fbx', '.abc', '.obj')
+UDIM_TILES = (1001, 1999)
+
+
+def buildClassifier(categories):
+	"""Maps every extension to its category, and returns the map with the
+	length of the longest extension."""
+	classifier = {}
+	for category, extensions in categories:
+		for ext in extensions:
+			classifier.setdefault(ext, category)
+	return classifier, max(len(ext) for ext in classifier)
+
+
+CLASSIFIER, MAX_EXTENSION_LENGTH = buildClassifier(CATEGORIES)
+
+
+def classify(filename):
+	"""Returns the category, the extension and the node name of the file.
+	The extension is the longest one of type_extensions that ends the
+	filename, the category is None if there is none."""
+	name = os.path.basename(filename).split(os.extsep)[0]
+	name = WHITESPACE.sub('_', FRAME_TOKEN.sub('', name))
+	for start in range(max(0, len(filename) - MAX_EXTENSION_LENGTH), len(filename)):
+		category = CLASSIFIER.get(filename[start:])
+		if category is not None:
+			return category, filename[start:], name
+	return None, '', name
+
+
+def frameRanges(frames):
+	"""Returns the sorted frames as ranges, 1001-1050 1052-1100 when frame
+	1051 is missing."""
+	ranges = []
+	first = last = frames[0]
+	for frame in frames[1:]:
+		if frame != last + 1:
+			ranges.append((first, last))
+			first = frame
+		last = frame
+	ranges.append((first, last))
+	return ' '.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+
+def sequenceToken(numbers, udim=False):
+	"""Returns the token that replaces the numbers of a sequence, or None
+	if their padding is inconsistent."""
+	width = min(len(number) for number in numbers)
+	for number in numbers:
+		if len(number) != width and number.startswith('0'):
+			return None
+	frames = [int(number) for number in numbers]
+	if udim and width == 4 and UDIM_TILES[0] <= frames[0] and frames[-1] <= UDIM_TILES[1]:
+		return '<UDIM>'
+	return '$F{}'.format(width) if width > 1 else '$F'
+
+
+def collapseSequences(filelist, udim=False):
+	"""Groups the name.####.ext files of the list into sequences, and with
+	udim the name_####.ext UDIM tiles too, with one sort and scan over the
+	list. Returns the file name, the sorted frames and the files of each
+	sequence, in the order of the list. The file name of a sequence has a
+	$F or a <UDIM> token in place of the numbers; single files have no
+	frames."""
+	entries = []
+	singles = []
+	for index, filename in enumerate(filelist):
+		category, ext, name = classify(filename)
+		match = None
+		if category in SEQUENCE_CATEGORIES and ext not in SEQUENCE_EXCLUDED_EXTENSIONS:
+			stem = filename[:len(filename) - len(ext)]
+			match = FRAME_NUMBER.match(stem) or (udim and UDIM_NUMBER.match(stem))
+		if match:
+			head, number = match.groups()
+			entries.append((head, ext, int(number), index, number, filename))
+		else:
+			singles.append((index, filename, [], [filename]))
+
+	entries.sort()
+	sequences = []
+	start = 0
+	while start < len(entries):
+		head, ext = entries[start][:2]
+		end = start + 1
+		while end < len(entries) and entries[end][:2] == (head, ext):
+			end += 1
+		run = entries[start:end]
+		token = sequenceToken([entry[4] for entry in run], udim) if len(run) > 1 else None
+		if token is None or (head.endswith('_') and token != '<UDIM>'):
+			sequences.extend((entry[3], entry[5], [], [entry[5]]) for entry in run)
+		else:
+			frames = [entry[2] for entry in run]
+			files = [entry[5] for entry in run]
+			sequences.append((min(entry[3] for entry in run), head + token + ext, frames, files))
+		start = end
+
+	return [sequence[1:] for sequence in sorted(singles + sequences)]
+
+
+def probeFile(filename):
+	"""Stats the file and matches the start of it against SIGNATURES. Runs
+	in the probe threads, so it must not touch hou."""
+	try:
+		size = os.path.getsize(filename)
+		with open(filename, 'rb') as f:
+			header = f.read(HEADER_SIZE)
+	except (IOError, OSError) as err:
+		return Probe(filename, None, None, err.strerror or str(err))
+
+	signature = None
+	for magic, name in SIGNATURES:
+		if header.startswith(magic):
+			signature = name
+			break
+
+	error = None
+	if not size:
+		error = 'empty file'
+	else:
+		for suffix, expected in EXPECTED_SIGNATURES:
+			if filename.endswith(suffix) and signature not in expected:
+				error = 'no {} header'.format(' or '.join(expected))
+				break
+	return Probe(filename, size, signature, error)
+
+
+def probeFiles(filelist, callback):
+	"""Probes the files in a pool of threads, so slow storage does not block
+	the UI, and calls callback with the probes on the main thread once they
+	are all done. Without a UI to defer to, waits for the probes."""
+	pool = ThreadPool(max(1, min(PROBE_THREADS, len(filelist))))
+	try:
+		import hdefereval
+	except ImportError:
+		try:
+			probes = pool.map(probeFile, filelist)
+		finally:
+			pool.close()
+		callback(probes)
+		return
 
-def baseName(filename, extensions):
-	filepath, basename = os.path.split(filename)
-	name = basename.split(os.extsep)[0]
-	ext = matchTypes(extensions).search(filename).group() if matchTypes(extensions).search(filename) else ''
-	return name, ext
+	pool.map_async(probeFile, filelist,
+				   callback=lambda probes: hdefereval.executeDeferred(callback, probes))
+	pool.close()
 
 
-def copImages(network, ctx, filename):
-	if not matchTypes(IMAGE_EXTENSIONS).search(filename):
+def packedLoad(node, probe):
+	"""Loads a file of PACKED_LOAD_SIZE or more as packed primitives drawn
+	as bounding boxes, so that a heavy cache is not read into memory when
+	the viewport cooks. The Load Full Geometry button of the node switches
+	it to a full load."""
+	parms = PACKED_LOAD_PARMS.get(node.type().name())
+	if (PACKED_LOAD_SIZE is None or parms is None or probe is None
+			or probe.size is None or probe.size < PACKED_LOAD_SIZE):
 		return
 
-	name = baseName(filename, IMAGE_EXTENSIONS)[0]
-	name = re.sub(r'\s+', '_', name)
+	node.setParms(dict((name, values[0]) for name, values in parms.items()))
+	full = dict((name, values[1]) for name, values in parms.items())
+	group = node.parmTemplateGroup()
+	group.append(hou.ButtonParmTemplate('loadfull', 'Load Full Geometry',
+		script_callback="kwargs['node'].setParms({!r})".format(full),
+		script_callback_language=hou.scriptLanguage.Python))
+	node.setParmTemplateGroup(group)
+	node.setColor(hou.Color(PACKED_NODE_COLOR))
 
+
+def copImages(network, ctx, filename, name, ext):
 	image = ctx.createNode('file', node_name=name)
 	image.setColor(hou.Color(IMAGE_NODE_COLOR))
 	image.setPosition(position)
 	image.parm('filename1').set(filename)
+	return image
 
 
-def chanFiles(network, ctx, filename):
-	if not matchTypes(CHAN_EXTENSIONS).search(filename):
-		return
-
-	name = baseName(filename, CHAN_EXTENSIONS)[0]
-	name = re.sub(r'\s+', '_', name)
-
+def chanFiles(network, ctx, filename, name, ext):
 	chan = ctx.createNode('file', node_name=name)
 	chan.setColor(hou.Color(CLIP_NODE_COLOR))
 	chan.setPosition(position)
 	chan.parm('file').set(filename)
+	return chan
 
 
-def shopImages(network, ctx, filename):
-	if not matchTypes(IMAGE_EXTENSIONS).search(filename):
-		return
-
-	name = baseName(filename, IMAGE_EXTENSIONS)[0]
-	name = re.sub(r'\s+', '_', name)
-
+def shopImages(network, ctx, filename, name, ext):
 	if ctx.type().name() == 'mat' or ctx.type().name() == 'vopmaterial':
 		image = ctx.createNode('texture', node_name=name)
 		image.parm('map').set(filename)
@@ -74,15 +261,10 @@ def shopImages(network, ctx, filename):
 
 	image.setColor(hou.Color(IMAGE_NODE_COLOR))
 	image.setPosition(position)
+	return image
 
 
-def objGeom(network, ctx, filename):
-	if not matchTypes(GEO_EXTENSIONS).search(filename):
-		return
-
-	name, ext = baseName(filename, GEO_EXTENSIONS)
-	name = re.sub(r'\s+', '_', name)
-
+def objGeom(network, ctx, filename, name, ext, probe=None):
 	if ext == '.fbx':
 		hou.hipFile.importFBX(filename)
 		return
@@ -91,7 +273,7 @@ def objGeom(network, ctx, filename):
 		procedural = ctx.createNode('arnold_procedural', node_name=name.title())
 		procedural.setPosition(position)
 		procedural.parm('ar_filename').set(filename)
-		return
+		return procedural
 
 	geo = ctx.createNode('geo', node_name=name.title())
 	geo.setPosition(position)
@@ -99,77 +281,141 @@ def objGeom(network, ctx, filename):
 	for child in geo.children():
 		child.destroy()
 
-	if ext == '.abc':
+	# the header tells an Alembic archive apart whatever its extension
+	if ext == '.abc' or (probe and probe.signature == 'alembic'):
 		alembic = geo.createNode('alembic', node_name='Import_Alembic')
 		geo.setColor(hou.Color(ALEMBIC_NODE_COLOR))
 		alembic.parm('fileName').set(filename)
+		packedLoad(alembic, probe)
 	else:
 		geometry = geo.createNode('file', node_name='Import_Geometry')
 		geo.setColor(hou.Color(GEO_NODE_COLOR))
 		geometry.parm('file').set(filename)
+		packedLoad(geometry, probe)
+	return geo
 
 
-def sopGeom(network, ctx, filename):
-	if not matchTypes(GEO_EXTENSIONS).search(filename):
-		return
-
-	name, ext = baseName(filename, GEO_EXTENSIONS)
-	name = re.sub(r'\s+', '_', name)
-
+def sopGeom(network, ctx, filename, name, ext, probe=None):
 	if ext == '.ass':
 		procedural = ctx.createNode('arnold_asstoc', node_name=name.title())
 		procedural.setPosition(position)
 		procedural.parm('ass_file').set(filename)
-		return
+		return procedural
 
-	if ext == '.abc':
+	if ext == '.abc' or (probe and probe.signature == 'alembic'):
 		alembic = ctx.createNode('alembic', node_name=name)
 		alembic.setColor(hou.Color(ALEMBIC_NODE_COLOR))
 		alembic.setPosition(position)
 		alembic.parm('fileName').set(filename)
+		packedLoad(alembic, probe)
+		return alembic
 	else:
 		geometry = ctx.createNode('file', node_name=name)
 		geometry.setColor(hou.Color(GEO_NODE_COLOR))
 		geometry.setPosition(position)
 		geometry.parm('file').set(filename)
+		packedLoad(geometry, probe)
+		return geometry
 
 
-def hdaAsset(network, ctx, filename):
-	if not matchTypes(ASSET_EXTENSIONS).search(filename):
-		return
-
-	name, ext = baseName(filename, ASSET_EXTENSIONS)
+def hdaAsset(network, ctx, filename, name, ext):
 	hou.hda.installFile(filename)
 
 
-def loadContents(network, ctx, type_ctx, filename):
-	if type_ctx == hou.objNodeTypeCategory():
-		hdaAsset(network, ctx, filename)
+def loadContents(network, ctx, type_ctx, filename, probe=None):
+	"""Creates the node for the file in the network, and returns it. The
+	probe of the file, if any, can pick a loader other than the extension
+	would."""
+	category, ext, name = classify(filename)
 
 	if type_ctx == hou.objNodeTypeCategory():
-		objGeom(network, ctx, filename)
+		if category == 'asset':
+			return hdaAsset(network, ctx, filename, name, ext)
+		elif category == 'geo':
+			return objGeom(network, ctx, filename, name, ext, probe)
+
+	if type_ctx == hou.sopNodeTypeCategory() and category == 'geo':
+		return sopGeom(network, ctx, filename, name, ext, probe)
+
+	if type_ctx == hou.vopNodeTypeCategory() and category == 'image':
+		return shopImages(network, ctx, filename, name, ext)
 
-	if type_ctx == hou.sopNodeTypeCategory():
-		sopGeom(network, ctx, filename)
+	if type_ctx == hou.chopNodeTypeCategory() and category == 'chan':
+		return chanFiles(network, ctx, filename, name, ext)
 
-	if type_ctx == hou.vopNodeTypeCategory():
-		shopImages(network, ctx, filename)
+	if type_ctx == hou.cop2NodeTypeCategory() and category == 'image':
+		return copImages(network, ctx, filename, name, ext)
 
-	if type_ctx == hou.chopNodeTypeCategory():
-		chanFiles(network, ctx, filename)
 
-	if type_ctx ==  hou.cop2NodeTypeCategory():
-		copImages(network, ctx, filename)
+def gridPosition(origin, index, columns):
+	"""Returns the position of the index-th cell of a grid that starts at
+	origin and fills its rows first."""
+	row, column = divmod(index, columns)
+	return origin + hou.Vector2(column * GRID_SPACING[0], row * GRID_SPACING[1])
+
+
+def mergeNodes(ctx, nodes, position):
+	merge = ctx.createNode('merge', node_name='merge_dropped')
+	merge.setPosition(position)
+	for index, node in enumerate(nodes):
+		merge.setInput(index, node)
+	return merge
+
+
+def createNodes(network, ctx, type_ctx, origin, probes):
+	"""Creates the nodes of the probed files in one undo step, and reports
+	the files that could not be read."""
+	global position
+
+	failed = [probe for probe in probes if probe.error]
+	probes = [probe for probe in probes if not probe.error]
+	files = collapseSequences([probe.filename for probe in probes],
+							  udim=type_ctx == hou.vopNodeTypeCategory())
+	probes = dict((probe.filename, probe) for probe in probes)
+	columns = int(math.ceil(math.sqrt(len(files)))) if files else 1
+
+	update_mode = hou.updateModeSetting()
+	hou.setUpdateMode(hou.updateMode.Manual)
+	try:
+		with hou.undos.group('Drop files'):
+			nodes = []
+			for index, (filename, frames, sequence) in enumerate(files):
+				position = gridPosition(origin, index, columns)
+				node = loadContents(network, ctx, type_ctx, filename, probes[sequence[0]])
+				if node is not None:
+					nodes.append(node)
+					if frames:
+						label = 'Tiles ' if '<UDIM>' in filename else 'Frames '
+						node.setComment(label + frameRanges(frames))
+
+			if MERGE_DROPPED_SOPS and type_ctx == hou.sopNodeTypeCategory() and len(nodes) > 1:
+				rows = int(math.ceil(len(files) / float(columns)))
+				mergeNodes(ctx, nodes, gridPosition(origin, rows * columns, columns))
+	finally:
+		hou.setUpdateMode(update_mode)
+
+	if failed:
+		hou.ui.displayMessage('{} dropped files were skipped'.format(len(failed)),
+							  severity=hou.severityType.Warning,
+							  details='\n'.join('{}: {}'.format(probe.filename, probe.error)
+												for probe in failed))
+	return nodes
 
 
 def dropAccept(filelist):
 	# Exclude hip files
-    if filelist and os.path.splitext(filelist[0])[1] == ".hip":
-        return False
+	if filelist and os.path.splitext(filelist[0])[1] == ".hip":
+		return False
+
+	# Only the files a node can be created for are probed
+	filelist = [filename for filename in filelist if classify(filename)[0] is not None]
+	if not filelist:
+		return True
 
-    for filename in filelist:
-    	network, ctx, type_ctx = getNetworkEditor()
-    	cursorPosition(network) # The current cursor position for creating a node
-    	loadContents(network, ctx, type_ctx, filename)
+	# The editor and the cursor are looked up once for the whole drop,
+	# the nodes are created once the files are probed
+	network, ctx, type_ctx = getNetworkEditor()
+	origin = network.cursorPosition()
+	probeFiles(filelist, lambda probes: createNodes(network, ctx, type_ctx, origin, probes))
 
-    return True
\ No newline at end of file
+	return True
\ No newline at end of file
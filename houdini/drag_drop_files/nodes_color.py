@@ -4,4 +4,5 @@ ALEMBIC_NODE_COLOR = (0.38, 0.38, 0.38)
 FBX_NODE_COLOR = (0.451, 0.369, 0.796)
 CLIP_NODE_COLOR = (0.518, 0.561, 0.741)
 GEO_NODE_COLOR = (0.38, 0.38, 0.38)
-IMAGE_NODE_COLOR = (0.29, 0.565, 0.886)
\ No newline at end of file
+IMAGE_NODE_COLOR = (0.29, 0.565, 0.886)
+PACKED_NODE_COLOR = (0.867, 0.6, 0.2)
\ No newline at end of file